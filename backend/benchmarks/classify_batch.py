@@ -0,0 +1,121 @@
+"""
+Per-email vs batched classification: latency, tokens, cost and label agreement
+Uses the anthropic api when ANTHROPIC_API_KEY is set, otherwise a stub client that
+only measures prompt size (about 4 characters per token)
+python -m benchmarks.classify_batch --emails 150 [--pickle email_data.pickle]
+"""
+import argparse, asyncio, os, pickle, random, re, sys, time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from anthropic import AsyncAnthropic
+
+from benchmarks.html_to_text import corpus
+from integrations.email_body import body_to_text
+from integrations.gmail import GmailMessage
+import make_briefly
+from llm_gateway import LLMGateway
+from make_briefly import CATEGORIES, anthropic_cost, classify_email, classify_emails
+
+
+class UsageRecorder:
+    """
+    Wraps a client's messages.create, tallying requests and token usage
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.messages = self
+        self.requests = self.input_tokens = self.output_tokens = 0
+        self.cost = 0.0
+
+    async def create(self, **kwargs):
+        response = await self.client.messages.create(**kwargs)
+        self.requests += 1
+        self.input_tokens += response.usage.input_tokens
+        self.output_tokens += response.usage.output_tokens
+        self.cost += anthropic_cost(response.usage)
+        return response
+
+
+class StubClient:
+    """
+    Answers every request with a random valid label per email, usage estimated from prompt length
+    """
+
+    def __init__(self):
+        self.messages = self
+        self.rng = random.Random(0)
+
+    async def create(self, messages, **kwargs):
+        prompt = messages[0]["content"]
+        ids = re.findall(r'<email id="(\d+)">', prompt)
+        if ids:
+            text = "\n".join(f"{i}: {self.rng.choice(CATEGORIES)}" for i in ids)
+        else:
+            text = self.rng.choice(CATEGORIES)
+        usage = SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=len(text) // 4 + 1)
+        return SimpleNamespace(content=[SimpleNamespace(text=text)], usage=usage)
+
+
+def synthetic_emails(n: int):
+    emails = []
+    for i, (kind, mime_type, encoded) in enumerate(corpus(n)):
+        body = body_to_text(encoded, mime_type)
+        emails.append(
+            GmailMessage(
+                id=str(i), threadId=str(i), labels=[], snippet=body[:200], subject=f"{kind} {i}",
+                sender=f"Sender {i}", sender_email=f"sender{i}@example.com", body=body, body_loaded=True, date="0",
+            )
+        )
+    return emails
+
+
+async def run(client, emails, batched: bool, unlimited: bool):
+    recorder = UsageRecorder(client)
+    # uncached gateway per run, the stub has no rate limits
+    limits = dict(requests_per_minute=10**6, tokens_per_minute=10**9) if unlimited else {}
+    make_briefly.llm = LLMGateway(cache=None, **limits)
+    make_briefly.llm.client = recorder
+    start = time.perf_counter()
+    if batched:
+        labels, _ = await classify_emails(emails)
+    else:
+        labels = [label for label, _ in await asyncio.gather(*[classify_email(email) for email in emails])]
+    return labels, time.perf_counter() - start, recorder
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=150)
+    parser.add_argument("--pickle", help="EmailResponse pickle written by DEV mode")
+    args = parser.parse_args()
+
+    if args.pickle:
+        with open(args.pickle, "rb") as f:
+            data = pickle.load(f)
+        emails = data.personal_emails + data.news_emails + data.spam_emails
+    else:
+        emails = synthetic_emails(args.emails)
+
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    client = AsyncAnthropic(api_key=api_key, max_retries=0) if api_key else StubClient()
+    if not api_key:
+        print("ANTHROPIC_API_KEY not set, using stub client (token counts are estimates)")
+
+    single_labels, single_time, single = asyncio.run(run(client, emails, batched=False, unlimited=not api_key))
+    batch_labels, batch_time, batch = asyncio.run(run(client, emails, batched=True, unlimited=not api_key))
+    for name, elapsed, recorder in (("per-email", single_time, single), ("batched", batch_time, batch)):
+        print(
+            f"{name:>10}: {recorder.requests} requests, {elapsed:.2f}s, "
+            f"{recorder.input_tokens} input / {recorder.output_tokens} output tokens, ${recorder.cost:.4f}"
+        )
+    if api_key:
+        agree = sum(a == b for a, b in zip(single_labels, batch_labels))
+        print(f"label agreement: {agree}/{len(emails)}")
+
+
+if __name__ == "__main__":
+    main()
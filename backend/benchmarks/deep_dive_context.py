@@ -0,0 +1,128 @@
+"""
+Deep-dive research context: full page text (extract_text_from_html) vs main content + BM25 passages
+(page_content.build_research) on a corpus of pages
+Reports prompt tokens, extraction time and, on the synthetic corpus, how many of the planted on-topic facts
+survive into the prompt. --llm also times the summary call with each context (real api calls)
+python -m benchmarks.deep_dive_context --topics 20
+python -m benchmarks.deep_dive_context --pages fixtures/pages.jsonl --query "..."  # pages saved with FIXTURES=record
+"""
+import argparse, asyncio, json, random, re, sys, time
+from pathlib import Path
+from typing import List, Tuple
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from benchmarks.html_to_text import sentence
+from make_briefless import extract_text_from_html, summarize_search_results
+from page_content import RESEARCH_TOKEN_BUDGET, build_research
+from tokens import estimate_tokens
+
+SUBJECTS = "Acme Borealis Cygnus Dynamo Everest Fjord Gallium Helix Ion Juniper Krypton Lumen".split()
+OBJECTS = "chip rocket vaccine treaty merger reactor battery satellite telescope exchange".split()
+FACT = re.compile(r"FACT\d+_\d+")
+
+
+def paragraphs(rng: random.Random, count: int) -> str:
+    return "".join(f"<p>{' '.join(sentence(rng) for _ in range(4))}</p>" for _ in range(count))
+
+
+def page(rng: random.Random, subject: str, thing: str, facts: List[str]) -> str:
+    """
+    Article on the topic (facts spread among generic paragraphs) inside typical news site chrome
+    """
+    nav = "".join(f'<li><a href="/section/{i}">{sentence(rng, 2)}</a></li>' for i in range(40))
+    on_topic = [
+        f"<p>{subject} said the new {thing} would ship next year, {sentence(rng)} {fact} was confirmed by {subject} "
+        f"officials, who called the {thing} a turning point.</p>"
+        for fact in facts
+    ]
+    body = [paragraphs(rng, 1) for _ in range(25)] + on_topic
+    rng.shuffle(body)
+    related = "".join(f'<li><a href="/story/{i}">{sentence(rng, 8)}</a></li>' for i in range(15))
+    return (
+        f"<html><head><title>{subject} {thing}</title><script>{'var x=1;' * 500}</script>"
+        f"<style>{'.a{color:red}' * 200}</style></head><body>"
+        f'<header class="masthead"><nav><ul>{nav}</ul></nav></header>'
+        f'<div class="cookie-banner"><p>We use cookies to improve your experience, by continuing you accept them.</p></div>'
+        f'<div class="layout"><div class="story-body"><h1>{subject} unveils {thing}</h1>{"".join(body)}</div>'
+        f'<div class="sidebar"><h3>Most read</h3><ul>{related}</ul>{paragraphs(rng, 3)}</div></div>'
+        f'<div class="newsletter-signup"><p>Get the morning briefing in your inbox, sign up for free today.</p></div>'
+        f"<footer>{paragraphs(rng, 4)}</footer></body></html>"
+    )
+
+
+def synthetic(topics: int, pages_per_topic: int = 5, seed: int = 0) -> List[Tuple[str, List[str], List[str]]]:
+    rng = random.Random(seed)
+    corpus = []
+    for t in range(topics):
+        subject, thing = SUBJECTS[t % len(SUBJECTS)], OBJECTS[t % len(OBJECTS)]
+        query = f"{subject} unveils a new {thing}, {sentence(rng, 6)}"
+        facts = [f"FACT{t}_{i}" for i in range(pages_per_topic * 2)]
+        pages = [page(rng, subject, thing, facts[2 * p : 2 * p + 2]) for p in range(pages_per_topic)]
+        corpus.append((query, pages, facts))
+    return corpus
+
+
+def saved(path: str, query: str, pages_per_topic: int = 5) -> List[Tuple[str, List[str], List[str]]]:
+    with open(path) as f:
+        pages = [entry["value"] for entry in map(json.loads, f) if entry.get("value")]
+    return [(query, pages[i : i + pages_per_topic], []) for i in range(0, len(pages), pages_per_topic)]
+
+
+def research_prompt(pages: List[str]) -> str:
+    return "".join(f"\nPage {i+1}:\n" + text for i, text in enumerate(text for text in pages if text))
+
+
+async def summary_latency(contexts: List[Tuple[str, List[str]]]) -> List[float]:
+    """
+    One event loop for all calls, the anthropic client and gateway are loop bound
+    """
+    latency = []
+    for query, texts in contexts:
+        start = time.perf_counter()
+        await summarize_search_results(query, texts)
+        latency.append(time.perf_counter() - start)
+    return latency
+
+
+def measure(name: str, corpus, build, llm: bool):
+    tokens, recall, seconds, contexts = [], [], 0.0, []
+    for query, pages, facts in corpus:
+        start = time.perf_counter()
+        texts = build(query, pages)
+        seconds += time.perf_counter() - start
+        prompt = research_prompt(texts)
+        tokens.append(estimate_tokens(prompt))
+        if facts:
+            recall.append(len(set(FACT.findall(prompt)) & set(facts)) / len(facts))
+        contexts.append((query, texts))
+    line = (
+        f"{name:>12}: {sum(tokens) / len(tokens):8.0f} research tokens/prompt (max {max(tokens)}), "
+        f"extraction {seconds / len(corpus) * 1000:6.1f}ms/topic"
+    )
+    if recall:
+        line += f", fact recall {sum(recall) / len(recall):.0%}"
+    if llm:
+        latency = asyncio.run(summary_latency(contexts))
+        line += f", summary {sum(latency) / len(latency):.2f}s"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--topics", type=int, default=20, help="synthetic topics, 5 pages each")
+    parser.add_argument("--pages", help="pages.jsonl fixture file to use instead of the synthetic corpus")
+    parser.add_argument("--query", help="news segment the saved pages were searched for")
+    parser.add_argument("--llm", action="store_true", help="also time the summary call (real api calls)")
+    args = parser.parse_args()
+    if args.pages and not args.query:
+        parser.error("--pages needs the --query they were searched for")
+
+    corpus = saved(args.pages, args.query) if args.pages else synthetic(args.topics)
+    print(f"{len(corpus)} topics, {sum(len(pages) for _, pages, _ in corpus)} pages, budget {RESEARCH_TOKEN_BUDGET}")
+    measure("full pages", corpus, lambda query, pages: [extract_text_from_html(html) for html in pages], args.llm)
+    measure("bm25", corpus, build_research, args.llm)
+
+
+if __name__ == "__main__":
+    main()
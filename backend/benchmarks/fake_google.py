@@ -0,0 +1,227 @@
+"""
+Local stand-in for the Google APIs, used to benchmark the integrations offline.
+Every HTTP round trip sleeps for `latency` seconds to simulate network time.
+"""
+import base64, json, re, threading, time, uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.discovery import build
+
+
+def make_message(i: int) -> dict:
+    html = (
+        f"<html><body><h1>Update {i}</h1>"
+        + "".join(f"<p>Paragraph {j} of message {i}. Some newsletter filler text.</p>" for j in range(20))
+        + "</body></html>"
+    )
+    return {
+        "id": f"msg{i:05d}",
+        "threadId": f"thread{i // 3:05d}",
+        "labelIds": ["INBOX", "CATEGORY_UPDATES" if i % 2 else "CATEGORY_PERSONAL"],
+        "snippet": f"Update {i} snippet",
+        "historyId": str(1000 + i),
+        "internalDate": str(1_700_000_000_000 + i * 60_000),
+        "payload": {
+            "mimeType": "text/html",
+            "headers": [
+                {"name": "Subject", "value": f"Update {i}"},
+                {"name": "From", "value": f"Sender {i % 7} <sender{i % 7}@example.com>"},
+                {"name": "To", "value": "me@example.com"},
+            ],
+            "body": {"data": base64.urlsafe_b64encode(html.encode()).decode()},
+        },
+    }
+
+
+class FakeGoogleState:
+    def __init__(self, num_messages: int = 200, latency: float = 0.05, calendars: int = 3, events_per_calendar: int = 4):
+        self.latency = latency
+        self.calendars = [f"calendar{i}" for i in range(calendars)]
+        self.events_per_calendar = events_per_calendar
+        self.messages: Dict[str, dict] = {m["id"]: m for m in map(make_message, range(num_messages))}
+        self.history: List[dict] = []
+        self.history_id = 1000 + num_messages
+        self.requests = 0  # http round trips served
+        self.lock = threading.Lock()
+
+    def calendar_events(self, calendar_id: str) -> List[dict]:
+        day = time.strftime("%Y-%m-%d")
+        return [
+            {
+                "id": f"{calendar_id}-event{i}",
+                "summary": f"Meeting {i}",
+                "creator": {"email": "me@example.com"},
+                "organizer": {"email": "me@example.com"},
+                "attendees": [{"email": f"sender{j}@example.com"} for j in range(i % 4 + 1)],
+                "start": {"dateTime": f"{day}T{9 + i:02d}:00:00Z"},
+                "end": {"dateTime": f"{day}T{9 + i:02d}:30:00Z"},
+            }
+            for i in range(self.events_per_calendar)
+        ]
+
+    def add_message(self) -> dict:
+        with self.lock:
+            message = make_message(len(self.messages))
+            self.history_id += 1
+            message["historyId"] = str(self.history_id)
+            self.messages[message["id"]] = message
+            self.history.append(
+                {"id": str(self.history_id), "messagesAdded": [{"message": {k: message[k] for k in ("id", "threadId", "labelIds")}}]}
+            )
+            return message
+
+    def route(self, method: str, path: str, query: Dict[str, List[str]], body: bytes) -> Tuple[int, dict]:
+        if method == "GET" and path == "/gmail/v1/users/me/messages":
+            ids = sorted(self.messages)
+            page_size = int(query.get("maxResults", ["100"])[0])
+            start = int(query.get("pageToken", ["0"])[0])
+            page = ids[start : start + page_size]
+            response = {
+                "messages": [{"id": i, "threadId": self.messages[i]["threadId"]} for i in page],
+                "resultSizeEstimate": len(ids),
+            }
+            if start + page_size < len(ids):
+                response["nextPageToken"] = str(start + page_size)
+            return 200, response
+        if method == "GET" and path == "/gmail/v1/users/me/profile":
+            return 200, {"emailAddress": "me@example.com", "historyId": str(self.history_id)}
+        if method == "GET" and path == "/gmail/v1/users/me/history":
+            start = int(query["startHistoryId"][0])
+            if start < 1000:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            records = [record for record in self.history if int(record["id"]) > start]
+            return 200, {"history": records, "historyId": str(self.history_id)}
+        if method == "GET" and path == "/gmail/v1/users/me/threads":
+            addresses = re.findall(r"[\w.]+@[\w.]+", query.get("q", [""])[0])
+            limit = int(query.get("maxResults", ["100"])[0])
+            thread_ids = sorted({
+                m["threadId"] for m in self.messages.values()
+                if any(a in h["value"] for h in m["payload"]["headers"] for a in addresses)
+            })
+            return 200, {"threads": [{"id": t} for t in thread_ids[:limit]]}
+        match = re.fullmatch(r"/gmail/v1/users/me/threads/([^/]+)", path)
+        if method == "GET" and match:
+            messages = [m for m in self.messages.values() if m["threadId"] == match.group(1)]
+            return 200, {"id": match.group(1), "messages": messages}
+        match = re.fullmatch(r"/gmail/v1/users/me/messages/([^/]+)", path)
+        if method == "GET" and match:
+            message = self.messages.get(match.group(1))
+            if message is None:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            if query.get("format", ["full"])[0] == "metadata":
+                return 200, {**message, "payload": {"headers": message["payload"]["headers"]}}
+            return 200, message
+        if method == "GET" and path == "/calendar/v3/users/me/calendarList":
+            return 200, {"items": [{"id": calendar_id} for calendar_id in self.calendars]}
+        match = re.fullmatch(r"/calendar/v3/calendars/([^/]+)/events", path)
+        if method == "GET" and match:
+            if "syncToken" in query:
+                return 200, {"items": [], "nextSyncToken": "sync-1"}
+            return 200, {"items": self.calendar_events(match.group(1)), "nextSyncToken": "sync-1"}
+        return 404, {"error": {"code": 404, "message": f"No fake route for {method} {path}"}}
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    server_version = "FakeGoogle/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self) -> FakeGoogleState:
+        return self.server.state
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method: str):
+        with self.state.lock:
+            self.state.requests += 1
+        time.sleep(self.state.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        url = urlparse(self.path)
+        if url.path.startswith("/batch/"):
+            return self._handle_batch(body)
+        status, response = self.state.route(method, url.path, parse_qs(url.query), body)
+        self._send(status, json.dumps(response).encode(), "application/json")
+
+    def _handle_batch(self, body: bytes):
+        content_type = self.headers["Content-Type"]
+        mime = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in mime.get_payload():
+            request_line, _, rest = part.get_payload().partition("\n")
+            method, target, _ = request_line.split(" ", 2)
+            inner_body = rest.replace("\r\n", "\n").partition("\n\n")[2].encode()
+            url = urlparse(target)
+            status, response = self.state.route(method, url.path, parse_qs(url.query), inner_body)
+            payload = json.dumps(response)
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'].strip('<>')}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n"
+                f"Content-Length: {len(payload)}\r\n\r\n"
+                f"{payload}\r\n"
+            )
+        response = "".join(parts) + f"--{boundary}--\r\n"
+        self._send(200, response.encode(), f"multipart/mixed; boundary={boundary}")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+class FakeGoogleServer:
+    """
+    with FakeGoogleServer(num_messages=200, latency=0.05) as server:
+        service = server.build("gmail", "v1")
+    """
+
+    def __init__(self, num_messages: int = 200, latency: float = 0.05, port: int = 0, **kwargs):
+        self.state = FakeGoogleState(num_messages=num_messages, latency=latency, **kwargs)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), FakeGoogleHandler)
+        self.httpd.state = self.state
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def batch_uri(self, service_name: str = "gmail", version: str = "v1") -> str:
+        return f"{self.url}batch/{service_name}/{version}"
+
+    def build(self, service_name: str, version: str):
+        api_endpoint = self.url if service_name == "gmail" else f"{self.url}{service_name}/{version}/"
+        return build(
+            service_name,
+            version,
+            http=httplib2.Http(),
+            client_options={"api_endpoint": api_endpoint},
+            static_discovery=True,
+        )
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,50 @@
+"""
+Serial vs batched gmail message fetch against the local fake gmail endpoint
+python -m benchmarks.gmail_fetch --messages 200 --latency 0.05 --batch-size 50
+"""
+import argparse, asyncio, sys, time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from benchmarks.fake_google import FakeGoogleServer
+from integrations.gmail import batch_get_messages, parse_message
+
+
+def fetch_serial(service, message_ids):
+    return [
+        service.users().messages().get(userId="me", id=message_id, format="full").execute()
+        for message_id in message_ids
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+
+    with FakeGoogleServer(num_messages=args.messages, latency=args.latency) as server:
+        service = server.build("gmail", "v1")
+        message_ids = sorted(server.state.messages)
+
+        server.state.requests = 0
+        start = time.perf_counter()
+        serial = [parse_message(m) for m in fetch_serial(service, message_ids)]
+        serial_time, serial_requests = time.perf_counter() - start, server.state.requests
+
+        server.state.requests = 0
+        start = time.perf_counter()
+        raw = asyncio.run(batch_get_messages(service, message_ids, batch_size=args.batch_size, batch_uri=server.batch_uri()))
+        batched = [parse_message(m) for m in raw]
+        batched_time, batched_requests = time.perf_counter() - start, server.state.requests
+
+    assert [m.id for m in serial] == [m.id for m in batched], "batched fetch returned different messages"
+    print(f"serial:  {len(serial)} messages, {serial_requests} round trips, {serial_time:.2f}s")
+    print(f"batched: {len(batched)} messages, {batched_requests} round trips, {batched_time:.2f}s")
+    print(f"speedup: {serial_time / batched_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
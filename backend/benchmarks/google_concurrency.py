@@ -0,0 +1,61 @@
+"""
+Concurrent users fetching from the local fake google api, blocking client calls vs the google_async layer
+Reports total wall time and the worst event loop stall seen by a heartbeat task
+python -m benchmarks.google_concurrency --users 20 --gets 10 --latency 0.05
+"""
+import argparse, asyncio, sys, time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from benchmarks.fake_google import FakeGoogleServer
+from integrations import google_async
+
+
+async def blocking_user(service, gets: int):
+    results = service.users().messages().list(userId="me", maxResults=gets).execute()
+    for message in results["messages"]:
+        service.users().messages().get(userId="me", id=message["id"]).execute()
+
+
+async def async_user(service, gets: int):
+    results = await google_async.execute(service.users().messages().list(userId="me", maxResults=gets))
+    for message in results["messages"]:
+        await google_async.execute(service.users().messages().get(userId="me", id=message["id"]))
+
+
+async def heartbeat(stop: asyncio.Event, interval: float = 0.01) -> float:
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def run(user, services, gets: int):
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(heartbeat(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[user(service, gets) for service in services])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await monitor
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--gets", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with FakeGoogleServer(num_messages=args.gets, latency=args.latency) as server:
+        services = [server.build("gmail", "v1") for _ in range(args.users)]
+        for name, user in (("blocking", blocking_user), ("google_async", async_user)):
+            elapsed, stall = asyncio.run(run(user, services, args.gets))
+            print(f"{name:>12}: {args.users} users x {args.gets + 1} calls in {elapsed:.2f}s, worst loop stall {stall * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
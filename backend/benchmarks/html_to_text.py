@@ -0,0 +1,107 @@
+"""
+Throughput and output agreement of the email body engines on a synthetic corpus
+of newsletter and personal email payloads, against the original bs4 html.parser path
+python -m benchmarks.html_to_text --emails 200
+"""
+import argparse, base64, random, sys, time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from integrations.email_body import ENGINES, body_to_text, html_to_text_bs4
+
+WORDS = (
+    "market policy launch model research funding startup climate election chip energy "
+    "court ruling quarter earnings league release study vaccine satellite network"
+).split()
+
+
+def sentence(rng: random.Random, n: int = 14) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+def newsletter(rng: random.Random) -> str:
+    """
+    Table-based layout with inline styles, tracking pixels, link-heavy sections and a footer, like most newsletters
+    """
+    style = "<style>" + "".join(f".c{i}{{color:#{i:03d};padding:{i}px}}" for i in range(200)) + "</style>"
+    sections = []
+    for i in range(rng.randint(8, 20)):
+        paragraphs = "".join(
+            f'<p style="margin:0 0 12px;font-family:Arial">{sentence(rng)} <a href="https://example.com/{i}/{j}?utm_source=news">'
+            f"{sentence(rng, 4)}</a></p>"
+            for j in range(rng.randint(2, 6))
+        )
+        sections.append(
+            f'<tr><td class="c{i}" style="padding:16px"><h2 style="font-size:20px">{sentence(rng, 6)}</h2>'
+            f'<img src="https://example.com/img/{i}.png" width="600">{paragraphs}</td></tr>'
+        )
+    footer = '<tr><td><p>You are receiving this email because you subscribed. <a href="#">Unsubscribe</a></p></td></tr>'
+    pixel = '<img src="https://track.example.com/open.gif" width="1" height="1">'
+    return (
+        f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{sentence(rng, 5)}</title>{style}</head>"
+        f"<body><!-- preheader --><table width='100%'><tbody>{''.join(sections)}{footer}</tbody></table>{pixel}"
+        "<script>var t=1;</script></body></html>"
+    )
+
+
+def personal_html(rng: random.Random) -> str:
+    quote = "".join(f"<div>{sentence(rng)}</div>" for _ in range(rng.randint(2, 8)))
+    return (
+        f'<div dir="ltr"><div>Hi,</div><div><br></div><div>{sentence(rng)} {sentence(rng)}</div>'
+        f'<div><br></div><div>Thanks</div></div><br><div class="gmail_quote"><blockquote>{quote}</blockquote></div>'
+    )
+
+
+def personal_plain(rng: random.Random) -> str:
+    return "Hi,\n\n" + "\n".join(sentence(rng) for _ in range(rng.randint(2, 6))) + "\n\nThanks\n> " + sentence(rng)
+
+
+def corpus(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    items = []
+    for i in range(n):
+        kind = rng.choice(["newsletter", "newsletter", "personal_html", "personal_plain"])
+        text = {"newsletter": newsletter, "personal_html": personal_html, "personal_plain": personal_plain}[kind](rng)
+        mime_type = "text/plain" if kind == "personal_plain" else "text/html"
+        items.append((kind, mime_type, base64.urlsafe_b64encode(text.encode()).decode()))
+    return items
+
+
+def original(encoded: str) -> str:
+    return html_to_text_bs4(base64.urlsafe_b64decode(encoded).decode("utf-8"))
+
+
+def agreement(a: str, b: str) -> float:
+    a_words, b_words = a.split(), b.split()
+    return 1.0 if a_words == b_words else len(set(a_words) & set(b_words)) / max(1, len(set(a_words) | set(b_words)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=200)
+    args = parser.parse_args()
+
+    items = corpus(args.emails)
+    megabytes = sum(len(encoded) * 3 / 4 for _, _, encoded in items) / 1e6
+    print(f"corpus: {len(items)} emails, {megabytes:.1f}MB decoded")
+
+    start = time.perf_counter()
+    reference = [original(encoded) for _, _, encoded in items]
+    baseline = time.perf_counter() - start
+    print(f"{'original bs4':>14}: {baseline:.2f}s, {megabytes / baseline:.1f}MB/s")
+
+    for engine in ENGINES:
+        start = time.perf_counter()
+        outputs = [body_to_text(encoded, mime_type, engine=engine) for _, mime_type, encoded in items]
+        elapsed = time.perf_counter() - start
+        scores = [agreement(ref, out) for ref, out in zip(reference, outputs)]
+        exact = sum(score == 1.0 for score in scores)
+        print(
+            f"{engine:>14}: {elapsed:.2f}s, {megabytes / elapsed:.1f}MB/s, {baseline / elapsed:.1f}x, "
+            f"{exact}/{len(items)} identical word sequences, mean word overlap {sum(scores) / len(scores):.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
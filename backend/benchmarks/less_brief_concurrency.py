@@ -0,0 +1,108 @@
+"""
+20 simultaneous /api/less-brief deep dives on one event loop
+Search results and pages are replayed from synthetic fixtures, the anthropic client is a stub that sleeps,
+so the run is offline. Reports single-request time, wall time for the concurrent batch and the longest
+event loop stall; a serialized worker would take ~requests x single time and stall for whole requests
+python -m benchmarks.less_brief_concurrency --requests 20
+"""
+import argparse, asyncio, json, os, random, sys, tempfile, time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from anthropic.types import Message
+
+from benchmarks.html_to_text import sentence
+from fixtures import fixture_key, fixtures
+from llm_gateway import LLMGateway
+import make_briefless
+
+
+class StubClient:
+    def __init__(self, latency: float):
+        self.messages = self
+        self.latency = latency
+
+    async def create(self, messages, **kwargs):
+        await asyncio.sleep(self.latency)
+        return Message(
+            id="stub", type="message", role="assistant", model=kwargs["model"], stop_reason="end_turn",
+            content=[{"type": "text", "text": "A comprehensive summary."}],
+            usage={"input_tokens": len(messages[0]["content"]) // 4, "output_tokens": 500},
+        )
+
+
+def article(rng: random.Random) -> str:
+    nav = "".join(f'<li><a href="/section/{i}">{sentence(rng, 2)}</a></li>' for i in range(40))
+    body = "".join(f"<p>{' '.join(sentence(rng) for _ in range(5))}</p>" for _ in range(60))
+    return (
+        f"<html><head><title>{sentence(rng, 6)}</title><script>{'var x=1;' * 500}</script></head><body>"
+        f"<nav><ul>{nav}</ul></nav><article><h1>{sentence(rng, 8)}</h1>{body}</article>"
+        f"<footer>{sentence(rng)}</footer></body></html>"
+    )
+
+
+def write_fixtures(path: str, queries, seed: int = 0):
+    rng = random.Random(seed)
+    with open(os.path.join(path, "search.jsonl"), "w") as search, open(os.path.join(path, "pages.jsonl"), "w") as pages:
+        for q, query in enumerate(queries):
+            results = [
+                {"title": sentence(rng, 6), "href": f"https://news{i}.example.com/{q}", "body": sentence(rng)}
+                for i in range(10)
+            ]
+            entry = {"key": fixture_key(query=query, num=10), "elapsed": 0.4, "value": results, "error": None}
+            search.write(json.dumps(entry) + "\n")
+            for result in results[:5]:
+                key = fixture_key(url=result["href"], tier="http")
+                entry = {"key": key, "elapsed": rng.uniform(0.2, 1.0), "value": article(rng), "error": None}
+                pages.write(json.dumps(entry) + "\n")
+
+
+async def run(queries, llm_latency: float):
+    # rate limits off, the stub has none and this measures the event loop, not the api quota
+    make_briefless.llm = gateway = LLMGateway(cache=None, requests_per_minute=10**6, tokens_per_minute=10**9)
+    gateway.client = StubClient(llm_latency)
+
+    stall = 0.0
+    done = False
+
+    async def probe():
+        nonlocal stall
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stall = max(stall, time.perf_counter() - start - 0.01)
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await make_briefless.generate_news_summary(queries[0])
+    single = time.perf_counter() - start
+
+    stall, start = 0.0, time.perf_counter()
+    await asyncio.gather(*[make_briefless.generate_news_summary(query) for query in queries[1:]])
+    concurrent = time.perf_counter() - start
+    done = True
+    await probe_task
+    return single, concurrent, stall
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=3.0, help="seconds per stubbed summary")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="scales replayed search and page times")
+    args = parser.parse_args()
+
+    queries = [f"news segment {i}: {sentence(random.Random(i), 10)}" for i in range(args.requests + 1)]
+    with tempfile.TemporaryDirectory() as path:
+        write_fixtures(path, queries)
+        fixtures.__init__(mode="replay", path=path, latency_scale=args.latency_scale, boundaries="search,pages")
+        single, concurrent, stall = asyncio.run(run(queries, args.llm_latency))
+
+    print(f"single deep dive: {single:.2f}s")
+    print(f"{args.requests} concurrent: {concurrent:.2f}s wall ({args.requests * single:.2f}s if serialized)")
+    print(f"longest event loop stall: {stall * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Whole-body vs EMAIL_TOKEN_BUDGET truncated summarization of long newsletters
+The anthropic api is stubbed with a latency model: a fixed overhead, prompt processing and output
+generation, scaled down by --time-scale so the run is quick. Reports requests, tokens, cost and wall time.
+The stub's topics are filler sized by prompt length, so this measures latency and cost, not summary quality
+python -m benchmarks.long_newsletter --tokens 2000 8000 30000 120000
+"""
+import argparse, asyncio, random, sys, time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import make_briefly
+from benchmarks.html_to_text import sentence
+from integrations.gmail import GmailMessage
+from llm_gateway import LLMGateway
+from make_briefly import EMAIL_TOKEN_BUDGET, anthropic_cost, summarize_news_email
+from tokens import estimate_tokens
+
+OVERHEAD = 0.4  # seconds per request
+PROMPT_TOKENS_PER_SECOND = 20_000
+OUTPUT_TOKENS_PER_SECOND = 60
+CONTEXT_LIMIT = 200_000
+
+
+class StubInstructor:
+    """
+    create_with_completion returning filler topics, one per ~400 prompt tokens (at most 25), tallying usage
+    """
+
+    def __init__(self, time_scale: float):
+        self.messages = self
+        self.time_scale = time_scale
+        self.requests = self.input_tokens = self.output_tokens = 0
+        self.cost = 0.0
+
+    async def create_with_completion(self, response_model, messages, max_tokens, **kwargs):
+        input_tokens = estimate_tokens(messages[0]["content"])
+        if input_tokens > CONTEXT_LIMIT:
+            raise ValueError(f"prompt is too long: {input_tokens} tokens > {CONTEXT_LIMIT} maximum")
+        topics = [f"Topic {i}: " + " ".join(["detail"] * 25) for i in range(min(25, input_tokens // 400 + 1))]
+        response = response_model(topic_summaries=topics)
+        output_tokens = min(max_tokens, estimate_tokens(response.model_dump_json()))
+        await asyncio.sleep(
+            self.time_scale
+            * (OVERHEAD + input_tokens / PROMPT_TOKENS_PER_SECOND + output_tokens / OUTPUT_TOKENS_PER_SECOND)
+        )
+        usage = SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens)
+        self.requests += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.cost += anthropic_cost(usage)
+        return response, SimpleNamespace(usage=usage)
+
+
+def long_newsletter(tokens: int, seed: int = 0) -> GmailMessage:
+    rng = random.Random(seed)
+    paragraphs, size = [], 0
+    while size < tokens:
+        paragraph = " ".join(sentence(rng) for _ in range(rng.randint(3, 8)))
+        paragraphs.append(paragraph)
+        size += estimate_tokens(paragraph) + 1
+    # html_to_text joins blocks with spaces, so most real bodies have no paragraph breaks left
+    body = " ".join(paragraphs)
+    return GmailMessage(
+        id=str(tokens), threadId=str(tokens), labels=[], snippet=body[:200], subject=f"Weekly digest ({tokens} tokens)",
+        sender="Digest", sender_email="digest@example.com", body=body, body_loaded=True, date="0",
+    )
+
+
+async def run(email: GmailMessage, budget: int, time_scale: float):
+    stub = StubInstructor(time_scale)
+    make_briefly.llm = LLMGateway(cache=None, requests_per_minute=10**6, tokens_per_minute=10**9)
+    make_briefly.llm.instructor = stub
+    make_briefly.EMAIL_TOKEN_BUDGET = budget
+    start = time.perf_counter()
+    try:
+        await summarize_news_email(email)
+        fits = True
+    except ValueError:
+        fits = False
+    return (time.perf_counter() - start) / time_scale, stub, fits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, nargs="+", default=[2000, 8000, 30000, 120000, 250000])
+    parser.add_argument("--time-scale", type=float, default=0.02)
+    args = parser.parse_args()
+
+    print(f"budget {EMAIL_TOKEN_BUDGET} tokens per email")
+    for tokens in args.tokens:
+        email = long_newsletter(tokens)
+        for name, budget in (("whole body", 10**9), ("budgeted", EMAIL_TOKEN_BUDGET)):
+            elapsed, stub, fits = asyncio.run(run(email, budget, args.time_scale))
+            outcome = "" if fits else ", context limit exceeded"
+            print(
+                f"{tokens:>7} tokens {name:>10}: {stub.input_tokens} input / {stub.output_tokens} output tokens, "
+                f"${stub.cost:.4f}, ~{elapsed:.1f}s modelled{outcome}"
+            )
+
+
+if __name__ == "__main__":
+    main()
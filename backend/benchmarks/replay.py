@@ -0,0 +1,55 @@
+"""
+Runs the briefing and deep-dive pipelines from recorded fixtures, no network needed
+Record once with real credentials (token_other.json and the api keys), then replay as often as needed
+python -m benchmarks.replay --mode record --runs 1 [--deep-dive "some news summary"]
+python -m benchmarks.replay --latency-scale 1.0 --runs 3 [--deep-dive "some news summary"]
+"""
+import argparse, asyncio, sys, time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from fixtures import fixtures
+from llm_gateway import LLMGateway
+import make_briefly
+import make_briefless
+
+
+async def run(deep_dives):
+    timings = {}
+    start = time.perf_counter()
+    await make_briefly.get_email_data()
+    timings["emails"] = time.perf_counter() - start
+    start = time.perf_counter()
+    await make_briefly.get_event_related_emails()
+    timings["calendar"] = time.perf_counter() - start
+    for summary in deep_dives:
+        start = time.perf_counter()
+        await make_briefless.generate_news_summary(summary)
+        timings[f"deep dive '{summary[:30]}'"] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["record", "replay"], default="replay")
+    parser.add_argument("--fixtures", default=fixtures.path)
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every replayed call")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--deep-dive", action="append", default=[])
+    args = parser.parse_args()
+
+    for i in range(args.runs):
+        # fresh replay positions, no cached searches and an uncached gateway (responses and classification labels)
+        # so every run does the same work
+        fixtures.__init__(mode=args.mode, path=args.fixtures, latency_scale=args.latency_scale, latency=args.latency)
+        make_briefless._searches.clear()
+        gateway = LLMGateway(cache=None)
+        make_briefly.llm = make_briefless.llm = gateway
+        timings = asyncio.run(run(args.deep_dive))
+        print(f"run {i + 1}: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Cost of building google api services, googleapiclient.discovery.build vs the cached factory in integrations.auth
+python -m benchmarks.service_build --requests 200
+"""
+import argparse, sys, time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+from integrations import auth
+
+
+def timed(fn, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    creds = Credentials(token="benchmark-token", scopes=auth.SCOPES)
+    start = time.perf_counter()
+    auth.preload_discovery_documents()
+    print(f"startup: preload discovery documents {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    for service_name, version in auth.DISCOVERY_DOCUMENTS:
+        uncached = timed(lambda: build(service_name, version, credentials=creds, static_discovery=True), args.requests)
+        from_document = timed(lambda: auth.build_service(service_name, version, creds), args.requests)
+        auth._services.clear()
+        tokens = iter(range(args.requests * 2))
+        cache_miss = timed(lambda: auth.get_google_api_service(service_name, version, f"token-{next(tokens)}"), args.requests)
+        cache_hit = timed(lambda: auth.get_google_api_service(service_name, version, "token-0"), args.requests)
+        print(
+            f"{service_name} {version}: build() {uncached:.2f}ms, from parsed document {from_document:.3f}ms, "
+            f"cache miss {cache_miss:.3f}ms, cache hit {cache_hit:.4f}ms per request"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Briefings computed ahead of time, stored in BriefingDB (one row per user for emails and calendar)
+The scheduler reads from UserDB.recommendations
+{
+    "google_refresh_token": Fernet encrypted (users.encrypt_token), sent by logins with offline access,
+    "timezone": from the user's calendar settings,
+}
+and builds each user's briefing once per local day, from BRIEFING_HOUR - BRIEFING_LEAD_HOURS, for users whose
+login granted a refresh token. A stored briefing is only served to the first request after it was built, every
+later request computes live so new mail and events show up
+One replica runs the scheduler at a time, holding a postgres advisory lock for each pass
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from fastapi.encoders import jsonable_encoder
+from google.auth.exceptions import RefreshError
+
+from sqlalchemy import func, text, update
+from sqlalchemy.dialects.postgresql import insert
+
+from users import BriefingDB, UserDB, decrypt_token, engine, sessionlocal
+from make_briefly import get_email_data, get_event_related_emails
+from integrations.auth import refresh_access_token
+from integrations.google_calendar import get_calendar_timezone
+from helpers import DEBUG, getenv
+
+BRIEFING_HOUR = getenv("BRIEFING_HOUR", 7)  # local hour briefings should be ready by
+BRIEFING_LEAD_HOURS = getenv("BRIEFING_LEAD_HOURS", 2)
+BRIEFING_MAX_AGE = getenv("BRIEFING_MAX_AGE", 6 * 3600)  # seconds an unseen stored briefing is served for
+BRIEFING_INTERVAL = getenv("BRIEFING_INTERVAL", 600)  # seconds between scheduler passes
+BRIEFING_CONCURRENCY = getenv("BRIEFING_CONCURRENCY", 2)  # users computed at once
+BRIEFING_LOCK_ID = getenv("BRIEFING_LOCK_ID", 180018)  # postgres advisory lock held by the running scheduler
+
+
+def _update(email: str, update: dict) -> dict:
+    session = sessionlocal()
+    try:
+        # row locked until commit, concurrent updates from other requests or replicas apply one after another
+        user = session.query(UserDB).filter(UserDB.email == email).with_for_update().first()
+        if user is None:
+            return {}
+        # assign a new dict, in-place changes to a JSON column are not tracked
+        user.recommendations = {**(user.recommendations or {}), **update}
+        session.commit()
+        return user.recommendations
+    finally:
+        session.close()
+
+
+def _users() -> list:
+    """
+    (email, recommendations, computed_at of the stored emails briefing or None) per user
+    """
+    session = sessionlocal()
+    try:
+        computed = dict(session.query(BriefingDB.email, BriefingDB.computed_at).filter(BriefingDB.kind == "emails"))
+        return [
+            (user.email, dict(user.recommendations or {}), computed.get(user.email))
+            for user in session.query(UserDB).all()
+        ]
+    finally:
+        session.close()
+
+
+def _take(email: str, kind: str, max_age: float) -> Optional[dict]:
+    session = sessionlocal()
+    try:
+        # one statement, two requests racing for the same briefing can't both get it
+        # only served_at is written, the stored data is left as is
+        row = session.execute(
+            update(BriefingDB)
+            .where(
+                BriefingDB.email == email,
+                BriefingDB.kind == kind,
+                BriefingDB.served_at.is_(None),
+                BriefingDB.computed_at > datetime.now(timezone.utc) - timedelta(seconds=max_age),
+            )
+            .values(served_at=func.now())
+            .returning(BriefingDB.data, BriefingDB.computed_at)
+            .execution_options(synchronize_session=False)
+        ).first()
+        session.commit()
+    finally:
+        session.close()
+    if row is None:
+        return None
+    return {**row.data, "computed_at": row.computed_at.isoformat()}
+
+
+def _store(email: str, kind: str, data: dict):
+    session = sessionlocal()
+    try:
+        values = {"email": email, "kind": kind, "data": data, "computed_at": datetime.now(timezone.utc)}
+        session.execute(
+            insert(BriefingDB)
+            .values(**values)
+            .on_conflict_do_update(index_elements=["email", "kind"], set_={**values, "served_at": None})
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def create_briefing_table():
+    try:
+        BriefingDB.__table__.create(engine, checkfirst=True)
+    except Exception as e:  # another replica created it first
+        print(f"Briefing table not created: {e}", flush=True)
+
+
+async def update_recommendations(email: str, **update) -> dict:
+    return await asyncio.to_thread(_update, email, update)
+
+
+async def precomputed_briefing(email: str, kind: str, max_age: float = BRIEFING_MAX_AGE) -> Optional[dict]:
+    """
+    Scheduler built emails or calendar briefing with its computed_at, marked served so it is only returned once
+    None when missing, already served or stale
+    """
+    return await asyncio.to_thread(_take, email, kind, max_age)
+
+
+async def store_briefing(email: str, kind: str, data):
+    await asyncio.to_thread(_store, email, kind, jsonable_encoder(data))
+
+
+def local_time(recommendations: dict, now: datetime) -> datetime:
+    try:
+        return now.astimezone(ZoneInfo(recommendations.get("timezone") or "UTC"))
+    except ZoneInfoNotFoundError:
+        return now.astimezone(timezone.utc)
+
+
+def is_due(recommendations: dict, computed_at: Optional[datetime], now: datetime) -> bool:
+    """
+    Due once the user's local clock passes BRIEFING_HOUR - BRIEFING_LEAD_HOURS, unless a briefing was computed_at since
+    """
+    if not recommendations.get("google_refresh_token"):
+        return False
+    local = local_time(recommendations, now)
+    window = local.replace(hour=BRIEFING_HOUR, minute=0, second=0, microsecond=0) - timedelta(hours=BRIEFING_LEAD_HOURS)
+    if local < window:
+        return False
+    return computed_at is None or computed_at < window
+
+
+async def build_briefing(email: str, recommendations: dict):
+    start = datetime.now(timezone.utc)
+    refresh_token = decrypt_token(recommendations["google_refresh_token"])
+    try:
+        if refresh_token is None:
+            raise ValueError("Stored refresh token can't be decrypted")
+        token = await asyncio.to_thread(refresh_access_token, refresh_token)
+    except (RefreshError, ValueError) as e:
+        if getattr(e, "retryable", False):  # token endpoint hiccup, not a bad grant
+            raise
+        # revoked, expired or undecryptable grant, wait for the next login instead of retrying every pass
+        await update_recommendations(email, google_refresh_token=None)
+        print(f"Briefing for {email} dropped its refresh token: {e}", flush=True)
+        return
+    # api and summary errors are raised to run_scheduler, which logs them, the user stays due for the next pass
+    if not recommendations.get("timezone"):
+        await update_recommendations(email, timezone=await get_calendar_timezone(token))
+    email_data, calendar_data = await asyncio.gather(
+        get_email_data(token=token, user_key=email),
+        get_event_related_emails(token=token, self_email=email),
+    )
+    await store_briefing(email, "emails", email_data)
+    await store_briefing(email, "calendar", calendar_data)
+    if DEBUG >= 1:
+        print(f"Briefing for {email} built in {(datetime.now(timezone.utc) - start).total_seconds():.1f}s", flush=True)
+
+
+def _acquire_lease():
+    """
+    Connection holding the scheduler's advisory lock, None when another replica holds it
+    The lock is tied to the connection, so it is released if this instance dies mid pass
+    """
+    connection = engine.connect()
+    try:
+        acquired = connection.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": BRIEFING_LOCK_ID}).scalar()
+        connection.commit()
+    except Exception:
+        connection.invalidate()
+        raise
+    if acquired:
+        return connection
+    connection.close()
+    return None
+
+
+def _release_lease(connection):
+    try:
+        connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": BRIEFING_LOCK_ID})
+        connection.commit()
+        connection.close()
+    except Exception:
+        # drop the connection rather than pool it with the lock still held
+        connection.invalidate()
+
+
+async def run_scheduler(interval: float = BRIEFING_INTERVAL):
+    """
+    Background loop started by every replica's lifespan, passes only run on the replica holding the lease
+    """
+    semaphore = asyncio.Semaphore(BRIEFING_CONCURRENCY)
+
+    async def build(email: str, recommendations: dict):
+        async with semaphore:
+            try:
+                await build_briefing(email, recommendations)
+            except Exception as e:
+                print(f"Briefing for {email} failed, retrying next pass: {e}", flush=True)
+
+    while True:
+        try:
+            lease = await asyncio.to_thread(_acquire_lease)
+            if lease is not None:
+                try:
+                    now = datetime.now(timezone.utc)
+                    users = await asyncio.to_thread(_users)
+                    due = [(email, rec) for email, rec, computed_at in users if is_due(rec, computed_at, now)]
+                    if due and DEBUG >= 1:
+                        print(f"Building {len(due)} briefings", flush=True)
+                    await asyncio.gather(*[build(email, rec) for email, rec in due])
+                finally:
+                    await asyncio.to_thread(_release_lease, lease)
+            elif DEBUG >= 1:
+                print("Briefing scheduler running on another replica", flush=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Briefing scheduler error: {e}", flush=True)
+        await asyncio.sleep(interval)
@@ -0,0 +1,133 @@
+"""
+Warm headless Chrome instances shared by the deep-dive scraper
+Drivers are borrowed per page, health checked on checkout and recycled after BROWSER_MAX_PAGES pages
+or any crash. BROWSER_POOL_SIZE and the per-renderer heap cap keep Chrome well inside Cloud Run's 4Gi
+"""
+import functools, os, queue, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from helpers import DEBUG, getenv
+
+CHROMEDRIVER_PATH = getenv("CHROMEDRIVER_PATH", "/usr/local/bin/chromedriver")  # installed by the Dockerfile
+BROWSER_POOL_SIZE = getenv("BROWSER_POOL_SIZE", 3)  # ~300-600MB each
+BROWSER_MAX_PAGES = getenv("BROWSER_MAX_PAGES", 50)  # pages before a browser is replaced
+BROWSER_PAGE_TIMEOUT = getenv("BROWSER_PAGE_TIMEOUT", 10)
+BROWSER_JS_HEAP_MB = getenv("BROWSER_JS_HEAP_MB", 256)  # V8 old space per renderer
+
+
+@functools.lru_cache(maxsize=None)
+def driver_path() -> str:
+    """
+    The image's chromedriver, or one downloaded once per process for local development
+    """
+    if os.path.exists(CHROMEDRIVER_PATH):
+        return CHROMEDRIVER_PATH
+    from webdriver_manager.chrome import ChromeDriverManager
+
+    return ChromeDriverManager().install()
+
+
+def chrome_options() -> Options:
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+    # memory: one renderer at a time, capped heap, no caches or background work
+    chrome_options.add_argument("--renderer-process-limit=1")
+    chrome_options.add_argument(f"--js-flags=--max-old-space-size={BROWSER_JS_HEAP_MB}")
+    chrome_options.add_argument("--disk-cache-size=1")
+    chrome_options.add_argument("--media-cache-size=1")
+    chrome_options.add_argument("--disable-background-networking")
+    chrome_options.add_argument("--disable-component-update")
+    chrome_options.add_argument("--disable-default-apps")
+    chrome_options.add_argument("--disable-sync")
+    chrome_options.add_argument("--mute-audio")
+    chrome_options.add_argument("--no-first-run")
+    chrome_options.page_load_strategy = "eager"
+    return chrome_options
+
+
+class PooledDriver:
+    def __init__(self):
+        self.driver = webdriver.Chrome(service=Service(driver_path()), options=chrome_options())
+        self.driver.set_page_load_timeout(BROWSER_PAGE_TIMEOUT)
+        self.pages = 0
+        self.broken = False
+
+    def healthy(self) -> bool:
+        try:
+            return self.driver.execute_script("return 1") == 1
+        except WebDriverException:
+            return False
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            pass
+
+
+class BrowserPool:
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_pages: int = BROWSER_MAX_PAGES):
+        self.size = size
+        self.max_pages = max_pages
+        self._idle: "queue.LifoQueue[PooledDriver]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def _checkout(self) -> PooledDriver:
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                return PooledDriver()
+            if pooled.healthy():
+                return pooled
+            pooled.quit()
+
+    def _checkin(self, pooled: PooledDriver):
+        pooled.pages += 1
+        if pooled.broken or pooled.pages >= self.max_pages or self._closed:
+            if DEBUG >= 1:
+                print(f"Recycling browser after {pooled.pages} pages (broken={pooled.broken})", flush=True)
+            pooled.quit()
+        else:
+            self._idle.put(pooled)
+
+    @contextmanager
+    def driver(self) -> Iterator[webdriver.Chrome]:
+        """
+        Borrow a browser, blocking while all BROWSER_POOL_SIZE are in use
+        A WebDriverException other than a timeout retires the browser
+        """
+        with self._slots:
+            pooled = self._checkout()
+            try:
+                yield pooled.driver
+            except WebDriverException as e:
+                pooled.broken = not isinstance(e, TimeoutException)
+                raise
+            finally:
+                self._checkin(pooled)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().quit()
+            except queue.Empty:
+                return
+
+
+browser_pool = BrowserPool()
+# selenium calls block for whole page loads, keep them off the default executor
+browser_executor = ThreadPoolExecutor(max_workers=BROWSER_POOL_SIZE, thread_name_prefix="browser")
@@ -5,16 +5,16 @@ import base64
 import json
 from elevenlabs import VoiceSettings
 from elevenlabs.client import ElevenLabs
-import anthropic
 from fastapi import APIRouter
 from fastapi.encoders import jsonable_encoder
 from sse_starlette.sse import EventSourceResponse
 from pydantic import BaseModel
 
+from llm_gateway import llm
+
 
 router = APIRouter()
 elvenlabs_client = ElevenLabs(api_key=os.environ.get("ELEVENLABS_API_KEY"))
-client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
 
 class BaseRequest(BaseModel):
@@ -31,12 +31,12 @@ class AudioAnswer(BaseModel):
 
 
 async def stream_data(query: str):
-    with client.messages.stream(
+    async with llm.stream(
             max_tokens=1024,
             temperature=0.0,
             messages=[{"role": "user", "content": query}],
             model="claude-3-5-sonnet-20240620") as stream:
-        for text in stream.text_stream:
+        async for text in stream.text_stream:
             yield json.dumps(jsonable_encoder(BaseAnswer(answer=text)))
 
 
@@ -46,13 +46,13 @@ async def stream_data_speech(query: str):
         accumulated_text = ""  # To accumulate text
         last_time = asyncio.get_event_loop().time()  # Get the current event loop time
 
-        with client.messages.stream(
+        async with llm.stream(
             max_tokens=1024,
             temperature=0.0,
             messages=[{"role": "user", "content": query}],
             model="claude-3-5-sonnet-20240620"
         ) as stream:
-            for text in stream.text_stream:
+            async for text in stream.text_stream:
                 print(f"Streaming: {text}", end="", flush=True)
                 full_text += text
                 accumulated_text += text  # Accumulate text
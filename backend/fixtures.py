@@ -0,0 +1,155 @@
+"""
+Record/replay of the integration boundaries: google api requests, anthropic, custom search and page fetches
+FIXTURES=record runs normally and appends every response to FIXTURES_DIR/<boundary>.jsonl
+FIXTURES=replay answers from those files without touching the network, sleeping
+recorded time * FIXTURES_LATENCY_SCALE + FIXTURES_LATENCY per call
+Identical requests replay their recorded responses in order, repeating the last one
+"""
+import asyncio, hashlib, json, os, re, threading, time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from helpers import getenv
+
+FIXTURES = getenv("FIXTURES", "")  # record, replay or off
+FIXTURES_DIR = getenv("FIXTURES_DIR", "fixtures")
+FIXTURES_LATENCY_SCALE = getenv("FIXTURES_LATENCY_SCALE", 1.0)  # multiplies recorded call time
+FIXTURES_LATENCY = getenv("FIXTURES_LATENCY", 0.0)  # seconds added to every replayed call
+FIXTURES_BOUNDARIES = getenv("FIXTURES_BOUNDARIES", "")  # comma separated subset, e.g. google,search; empty for all
+
+# google api query parameters holding the current date, dropped from keys so fixtures replay on later days
+VOLATILE_PARAMS = {"timeMin", "timeMax"}
+# date operators of gmail search queries, e.g. after:2024-06-01 before:2024/06/03 or after:1717200000
+SEARCH_DATE = re.compile(r"\b(after|before|older|newer):(?:\d{4}[/-]\d{1,2}[/-]\d{1,2}|\d{9,})")
+
+
+class FixtureMissing(KeyError):
+    pass
+
+
+def fixture_key(**parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def normalize_uri(uri: str) -> str:
+    """
+    Path and query only, without date-dependent google api parameters or the dates in gmail search queries
+    """
+    parsed = urlparse(uri)
+    params = []
+    for name, value in sorted(parse_qsl(parsed.query)):
+        if name in VOLATILE_PARAMS:
+            continue
+        if name == "q":
+            value = SEARCH_DATE.sub(r"\1:<date>", value)
+        params.append((name, value))
+    return f"{parsed.path}?{urlencode(params)}"
+
+
+class Fixtures:
+    def __init__(
+        self,
+        mode: str = FIXTURES,
+        path: str = FIXTURES_DIR,
+        latency_scale: float = FIXTURES_LATENCY_SCALE,
+        latency: float = FIXTURES_LATENCY,
+        boundaries: str = FIXTURES_BOUNDARIES,
+    ):
+        self.mode = mode
+        self.boundaries = {boundary.strip() for boundary in boundaries.split(",") if boundary.strip()}
+        self.path = path
+        self.latency_scale = latency_scale
+        self.latency = latency
+        self._entries: Dict[str, Dict[str, List[dict]]] = {}
+        self._positions: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def recording(self, boundary: str) -> bool:
+        return self.mode == "record" and (not self.boundaries or boundary in self.boundaries)
+
+    def replaying(self, boundary: str) -> bool:
+        return self.mode == "replay" and (not self.boundaries or boundary in self.boundaries)
+
+    def _file(self, boundary: str) -> str:
+        return os.path.join(self.path, f"{boundary}.jsonl")
+
+    def _load(self, boundary: str) -> Dict[str, List[dict]]:
+        if boundary not in self._entries:
+            entries = defaultdict(list)
+            if os.path.exists(self._file(boundary)):
+                with open(self._file(boundary)) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        entries[entry["key"]].append(entry)
+            self._entries[boundary] = entries
+        return self._entries[boundary]
+
+    def record(self, boundary: str, key: str, elapsed: float, value: Any = None, error: Any = None):
+        entry = {"key": key, "elapsed": elapsed, "value": value, "error": error}
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file(boundary), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def lookup(self, boundary: str, key: str, description: str = "") -> dict:
+        with self._lock:
+            entries = self._load(boundary).get(key)
+            if not entries:
+                raise FixtureMissing(f"No {boundary} fixture for {description or key}")
+            position = self._positions[(boundary, key)]
+            self._positions[(boundary, key)] += 1
+        return entries[min(position, len(entries) - 1)]
+
+    def delay(self, entry: dict) -> float:
+        return entry["elapsed"] * self.latency_scale + self.latency
+
+    async def call(
+        self,
+        boundary: str,
+        key: str,
+        fn: Callable,
+        dump: Callable = lambda value: value,
+        load: Callable = lambda value: value,
+        errors: Tuple[type, ...] = (),
+        dump_error: Optional[Callable] = None,
+        load_error: Optional[Callable] = None,
+        description: str = "",
+    ):
+        """
+        Awaits fn() unless replaying; errors listed in errors are recorded and raised again on replay
+        """
+        if self.replaying(boundary):
+            entry = self.lookup(boundary, key, description)
+            await asyncio.sleep(self.delay(entry))
+            if entry["error"] is not None:
+                raise load_error(entry["error"])
+            return load(entry["value"])
+        if not self.recording(boundary):
+            return await fn()
+        start = time.perf_counter()
+        try:
+            result = await fn()
+        except errors as e:
+            self.record(boundary, key, time.perf_counter() - start, error=dump_error(e))
+            raise
+        self.record(boundary, key, time.perf_counter() - start, value=dump(result))
+        return result
+
+    def call_sync(self, boundary: str, key: str, fn: Callable, description: str = ""):
+        """
+        call() for blocking code running on worker threads, values must be json serializable
+        """
+        if self.replaying(boundary):
+            entry = self.lookup(boundary, key, description)
+            time.sleep(self.delay(entry))
+            return entry["value"]
+        if not self.recording(boundary):
+            return fn()
+        start = time.perf_counter()
+        result = fn()
+        self.record(boundary, key, time.perf_counter() - start, value=result)
+        return result
+
+
+fixtures = Fixtures()
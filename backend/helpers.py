@@ -1,5 +1,6 @@
-import functools, os, contextlib, contextvars
-from typing import ClassVar, Dict, List
+import functools, os, contextlib, contextvars, threading, time
+from collections import OrderedDict
+from typing import Any, ClassVar, Dict, Hashable, List, Optional
 
 
 @functools.lru_cache(maxsize=None)
@@ -49,4 +50,56 @@ class ContextVar:
 
 
 DEBUG = ContextVar("DEBUG", int(os.environ.get("DEBUG", 0)))
-DEV = ContextVar("DEV", int(os.environ.get("DEV", 0)))
\ No newline at end of file
+DEV = ContextVar("DEV", int(os.environ.get("DEV", 0)))
+
+
+class TTLCache:
+    """
+    Thread-safe LRU mapping whose entries expire ttl seconds after they are set
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def setdefault(self, key: Hashable, default: Any) -> Any:
+        """
+        Like dict.setdefault, the entry's ttl restarts either way so values in use don't expire
+        """
+        with self._lock:
+            item = self._data.get(key)
+            value = default if item is None or item[0] <= time.monotonic() else item[1]
+        self.set(key, value)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
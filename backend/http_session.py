@@ -0,0 +1,36 @@
+"""
+Process-wide aiohttp session, one connection pool for page fetches and search
+Closed by the app's lifespan
+"""
+import asyncio
+from typing import Optional
+import aiohttp
+
+from helpers import getenv
+
+HTTP_CONNECTIONS = getenv("HTTP_CONNECTIONS", 100)
+HTTP_CONNECTIONS_PER_HOST = getenv("HTTP_CONNECTIONS_PER_HOST", 10)
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Created on first use, and again if the event loop changed (scripts calling asyncio.run repeatedly)
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTIONS, limit_per_host=HTTP_CONNECTIONS_PER_HOST, ttl_dns_cache=300
+        )
+        _session, _session_loop = aiohttp.ClientSession(connector=connector), loop
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
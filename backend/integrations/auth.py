@@ -1,9 +1,18 @@
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+from googleapiclient.discovery_cache import get_static_doc
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
+from datetime import datetime
 from typing import Optional
-import os, base64, re
+import os, base64, re, json, functools
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from helpers import TTLCache, getenv
 
 
 CREDENTIALS = "./gmail_other.json"
@@ -14,9 +23,73 @@ SCOPES = [
     "https://www.googleapis.com/auth/userinfo.email",
     "openid",
 ]
+DISCOVERY_DOCUMENTS = [("gmail", "v1"), ("calendar", "v3"), ("people", "v1")]
+SERVICE_TTL = getenv("GOOGLE_SERVICE_TTL", 3300)  # google access tokens live for an hour
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+
+_services = TTLCache(maxsize=getenv("GOOGLE_SERVICE_CACHE_SIZE", 256), ttl=SERVICE_TTL)
+
+
+@functools.lru_cache(maxsize=None)
+def discovery_document(service_name: str, version: str) -> dict:
+    """
+    Parsed discovery document from the copies bundled with google-api-python-client, no network
+    build_from_document fills in derived fields on first use and is idempotent after, so one dict is shared
+    """
+    document = get_static_doc(service_name, version)
+    if document is None:
+        raise ValueError(f"No bundled discovery document for {service_name} {version}")
+    return json.loads(document)
+
+
+def preload_discovery_documents():
+    for service_name, version in DISCOVERY_DOCUMENTS:
+        discovery_document(service_name, version)
+
+
+def build_service(service_name: str, version: str, creds: Credentials):
+    return build_from_document(discovery_document(service_name, version), credentials=creds)
+
+
+def build_offline_service(service_name: str, version: str):
+    """
+    Unauthenticated service for replayed fixtures, its requests never reach the network
+    """
+    return build_from_document(discovery_document(service_name, version), http=build_http())
+
+
+def credentials_ttl(creds: Credentials) -> float:
+    if creds.expiry is None:
+        return SERVICE_TTL
+    return max(0.0, (creds.expiry - datetime.utcnow()).total_seconds())
+
+
+def refresh_access_token(refresh_token: str) -> str:
+    """
+    New access token for an offline refresh token, issued to the GOOGLE_CLIENT_ID oauth client
+    Raises google.auth.exceptions.RefreshError when the grant was revoked or expired
+    """
+    creds = Credentials(
+        token=None,
+        refresh_token=refresh_token,
+        token_uri=TOKEN_URI,
+        client_id=os.environ.get("GOOGLE_CLIENT_ID"),
+        client_secret=os.environ.get("CLIENT_SECRET"),
+        scopes=SCOPES,
+    )
+    creds.refresh(Request())
+    return creds.token
 
 
 def get_google_api_service(service_name: str, version: str, token: Optional[str] = None):
+    """
+    Services are cached per token until the credentials expire
+    """
+    key = (service_name, version, token)
+    service = _services.get(key)
+    if service is not None:
+        return service
+
     if token is not None:
         creds = Credentials(token=token, scopes=SCOPES)
         if not creds.valid:
@@ -24,7 +97,6 @@ def get_google_api_service(service_name: str, version: str, token: Optional[str]
                 creds.refresh(Request())
             else:
                 raise ValueError("Invalid credentials")
-        return build(service_name, version, credentials=creds)
     else:
         creds = None
         if os.path.exists(TOKEN):
@@ -36,6 +108,9 @@ def get_google_api_service(service_name: str, version: str, token: Optional[str]
                 flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS, SCOPES)
                 creds = flow.run_local_server(port=0)
             assert (creds) is not None, "No GMAIL credientals found"
-            with open(TOKEN, 'w') as token:
-                token.write(creds.to_json())
-        return build(service_name, version, credentials=creds)
\ No newline at end of file
+            with open(TOKEN, 'w') as token_file:
+                token_file.write(creds.to_json())
+
+    service = build_service(service_name, version, creds)
+    _services.set(key, service, ttl=credentials_ttl(creds))
+    return service
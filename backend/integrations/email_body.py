@@ -0,0 +1,82 @@
+"""
+Email body -> plain text
+text/plain parts are decoded without any html parsing, html parts go through the configured engine
+"""
+import base64, re
+from typing import Callable, Dict
+from bs4 import BeautifulSoup
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from helpers import getenv
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+MAX_BODY_CHARS = getenv("MAX_BODY_CHARS", 200_000)  # decoded characters parsed per part
+HTML_ENGINE = getenv("HTML_ENGINE", "selectolax")
+NON_TEXT_TAGS = ["script", "style", "template", "noscript"]
+
+
+def html_to_text_bs4(html: str) -> str:
+    """
+    Reference implementation, pure python html.parser
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    return soup.get_text(separator=" ", strip=True)
+
+
+def html_to_text_selectolax(html: str) -> str:
+    tree = LexborHTMLParser(html)
+    tree.strip_tags(NON_TEXT_TAGS)
+    if tree.root is None:
+        return ""
+    return tree.root.text(separator=" ", strip=True)
+
+
+def html_to_text_lxml(html: str) -> str:
+    try:
+        root = lxml.html.document_fromstring(html)
+    except etree.ParserError:  # empty or whitespace-only document
+        return ""
+    etree.strip_elements(root, etree.Comment, *NON_TEXT_TAGS, with_tail=False)
+    return " ".join(text.strip() for text in root.itertext() if text.strip())
+
+
+ENGINES: Dict[str, Callable[[str], str]] = {"bs4": html_to_text_bs4}
+if LexborHTMLParser is not None:
+    ENGINES["selectolax"] = html_to_text_selectolax
+if lxml is not None:
+    ENGINES["lxml"] = html_to_text_lxml
+
+
+def get_engine(name: str = HTML_ENGINE) -> Callable[[str], str]:
+    """
+    Falls back to bs4 when the requested engine's package is not installed
+    """
+    return ENGINES.get(name, html_to_text_bs4)
+
+
+def decode_part(encoded_data: str, max_chars: int = MAX_BODY_CHARS) -> str:
+    # skip decoding what would be cut anyway: a char is at most 4 utf-8 bytes, base64 spends 4 chars per 3 bytes
+    limit = (max_chars * 4 // 3 + 1) * 4
+    data = encoded_data[:limit]
+    data += "=" * (-len(data) % 4)
+    return base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")[:max_chars]
+
+
+def body_to_text(encoded_data: str, mime_type: str = "text/html", engine: str = HTML_ENGINE) -> str:
+    text = decode_part(encoded_data)
+    if mime_type == "text/plain":
+        return re.sub(r"[ \t\r\f\v]+", " ", text).strip()
+    return get_engine(engine)(text)
@@ -1,7 +1,6 @@
-import os, base64, re
-from typing import List, Optional, Union
+import os, base64, re, asyncio
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple, Union
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from pydantic import BaseModel, Field
@@ -11,7 +10,27 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))
 
+from googleapiclient.errors import HttpError
+
 from integrations.auth import get_google_api_service
+from integrations import google_async
+from integrations.email_body import body_to_text
+from helpers import getenv
+
+
+GMAIL_BATCH_URI = getenv("GMAIL_BATCH_URI", "https://gmail.googleapis.com/batch/gmail/v1")
+GMAIL_BATCH_SIZE = getenv("GMAIL_BATCH_SIZE", 50)  # gmail allows 100, but throttles large batches
+GMAIL_PAGE_SIZE = getenv("GMAIL_PAGE_SIZE", 100)  # messages().list defaults to 100, max 500
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+METADATA_HEADERS = ["Subject", "From"]
+# kept on GmailMessage.headers for the rule-based pre-classifier
+SIGNAL_HEADERS = ["List-Unsubscribe", "List-Id", "Precedence", "Auto-Submitted", "X-Auto-Response-Suppress"]
+SIGNAL_HEADER_NAMES = {name.lower() for name in SIGNAL_HEADERS}
+# partial response masks, metadata skips the body entirely
+MESSAGE_FIELDS = {
+    "metadata": "id,threadId,labelIds,snippet,historyId,internalDate,payload/headers",
+    "full": "id,threadId,labelIds,snippet,historyId,internalDate,payload",
+}
 
 
 class GmailMessage(BaseModel):
@@ -22,7 +41,9 @@ class GmailMessage(BaseModel):
     subject: str = Field(default="")
     sender: str = Field(default="")
     sender_email: str = Field(default="")
-    body: str
+    headers: Dict[str, str] = Field(default_factory=dict)  # SIGNAL_HEADERS present on the message, lower-cased names
+    body: str = ""  # empty until load_message_bodies when fetched as metadata
+    body_loaded: bool = False
     date: str
     classification: Optional[str] = None
     summary: Union[str, List[str]] = ""
@@ -36,29 +57,119 @@ def extract_email(address):
     return address if "@" in address else ""
 
 
-def decode_and_clean(encoded_data):
-    decoded_data = base64.urlsafe_b64decode(encoded_data).decode("utf-8")
-    soup = BeautifulSoup(decoded_data, "html.parser")
-    return soup.get_text(separator=" ", strip=True)
+def decode_and_clean(encoded_data, mime_type: str = "text/html"):
+    return body_to_text(encoded_data, mime_type)
 
 
 def get_message_body(payload):
     if payload.get("body", {}).get("data"):
-        return decode_and_clean(payload["body"]["data"])
+        return decode_and_clean(payload["body"]["data"], payload.get("mimeType", "text/html"))
 
     if payload.get("parts"):
         for part in payload["parts"]:
-            if part["mimeType"].startswith("text"):
-                return decode_and_clean(part["body"]["data"])
+            if part["mimeType"].startswith("text") and part.get("body", {}).get("data"):
+                return decode_and_clean(part["body"]["data"], part["mimeType"])
             elif part["mimeType"].startswith("multipart"):
                 return get_message_body(part)
 
     return "No readable content found"
 
 
-def get_messages_since_yesterday(token: Optional[str] = None):
-    service = get_google_api_service("gmail", "v1", token)
-
+def parse_message(msg) -> GmailMessage:
+    """
+    Works on both format="full" and format="metadata" messages, the latter leave the body unloaded
+    """
+    payload = msg["payload"]
+    body_loaded = "body" in payload or "parts" in payload
+    headers = payload["headers"]
+    subject = next(
+        (header["value"] for header in headers if header["name"].lower() == "subject"),
+        "",
+    )
+    sender = next(
+        (header["value"] for header in headers if header["name"].lower() == "from"),
+        "",
+    )
+    try:
+        sender_email = sender.split("<")[1].split(">")[0]
+        sender = sender.split("<")[0].strip()
+    except Exception:
+        sender_email = sender
+        sender = sender
+
+    return GmailMessage(
+        id=msg["id"],
+        threadId=msg["threadId"],
+        labels=msg.get("labelIds", []),
+        snippet=msg["snippet"],
+        subject=subject,
+        sender=sender,
+        sender_email=sender_email,
+        headers={
+            header["name"].lower(): header["value"]
+            for header in headers
+            if header["name"].lower() in SIGNAL_HEADER_NAMES
+        },
+        body=get_message_body(payload) if body_loaded else "",
+        body_loaded=body_loaded,
+        date=msg["internalDate"],
+    )
+
+
+def message_params(format: str) -> dict:
+    params = {"format": format, "fields": MESSAGE_FIELDS[format]}
+    if format == "metadata":
+        params["metadataHeaders"] = METADATA_HEADERS + SIGNAL_HEADERS
+    return params
+
+
+async def batch_get_messages(
+    service,
+    message_ids: List[str],
+    format: str = "full",
+    batch_size: int = GMAIL_BATCH_SIZE,
+    max_retries: int = 3,
+    batch_uri: str = GMAIL_BATCH_URI,
+) -> List[dict]:
+    """
+    Fetch messages with gmail batch requests, batch_size gets per round trip
+    Items that fail with a retryable status are re-batched with backoff, others are skipped
+    Returns raw messages in the order of message_ids
+    """
+    message_ids = list(dict.fromkeys(message_ids))  # batch request ids must be unique
+    results: Dict[str, dict] = {}
+    pending = message_ids
+    for attempt in range(max_retries + 1):
+        retry = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif (
+                isinstance(exception, HttpError)
+                and exception.resp.status in RETRYABLE_STATUSES
+                and attempt < max_retries
+            ):
+                retry.append(request_id)
+            else:
+                print(f"Error fetching message {request_id}: {exception}", flush=True)
+
+        for i in range(0, len(pending), batch_size):
+            requests = [
+                (message_id, service.users().messages().get(userId="me", id=message_id, **message_params(format)))
+                for message_id in pending[i : i + batch_size]
+            ]
+            await google_async.execute_batch(service, requests, callback, batch_uri)
+
+        if not retry:
+            break
+        pending = retry
+        await asyncio.sleep(0.5 * 2**attempt)
+
+    return [results[message_id] for message_id in message_ids if message_id in results]
+
+
+def since_yesterday_query() -> str:
     # Calculate yesterday's date and today's date
     yesterday = datetime.now().replace(
         hour=0, minute=0, second=0, microsecond=0
@@ -71,162 +182,255 @@ def get_messages_since_yesterday(token: Optional[str] = None):
     now_plus_one = (now + timedelta(days=1)).strftime("%Y-%m-%d")
 
     # Construct the query
-    query = f"after:{yesterday_str} before:{now_plus_one}"
-
-    # Get messages
-    results = service.users().messages().list(userId="me", q=query).execute()
-    messages = results.get("messages", [])
-
-    downloaded_messages = []
-    for message in messages:
-        msg = (
-            service.users()
-            .messages()
-            .get(userId="me", id=message["id"], format="full")
-            .execute()
+    return f"after:{yesterday_str} before:{now_plus_one}"
+
+
+def parse_messages(messages: List[dict]) -> List[GmailMessage]:
+    return [parse_message(msg) for msg in messages]
+
+
+async def get_messages_since_yesterday(
+    token: Optional[str] = None, batch_size: int = GMAIL_BATCH_SIZE, service=None, format: str = "full"
+) -> List[GmailMessage]:
+    return [
+        message
+        async for message in stream_messages_since_yesterday(
+            token=token, batch_size=batch_size, service=service, format=format
+        )
+    ]
+
+
+async def stream_messages_since_yesterday(
+    token: Optional[str] = None,
+    batch_size: int = GMAIL_BATCH_SIZE,
+    page_size: int = GMAIL_PAGE_SIZE,
+    service=None,
+    format: str = "full",
+) -> AsyncIterator[GmailMessage]:
+    """
+    Yields messages one list page at a time, so callers can start on the first page
+    while later pages are still downloading
+    format="metadata" fetches headers, snippet and labels only, see load_message_bodies
+    """
+    if service is None:
+        service = await google_async.build_service("gmail", "v1", token)
+
+    query = since_yesterday_query()
+    page_token = None
+    while True:
+        results = await google_async.execute(
+            service.users().messages().list(
+                userId="me", q=query, maxResults=page_size, pageToken=page_token
+            )
         )
+        message_ids = [message["id"] for message in results.get("messages", [])]
+        raw_messages = await batch_get_messages(service, message_ids, format=format, batch_size=batch_size)
+        # body decoding is CPU heavy, keep it off the event loop
+        for message in await google_async.run(parse_messages, raw_messages):
+            yield message
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return
+
+
+def message_bodies(messages: List[dict]) -> Dict[str, str]:
+    return {msg["id"]: get_message_body(msg["payload"]) for msg in messages}
+
+
+async def load_message_bodies(
+    messages: List[GmailMessage], token: Optional[str] = None, service=None
+) -> List[GmailMessage]:
+    """
+    Second fetch tier: full bodies for the given messages, in place, skipping ones already loaded
+    """
+    pending = [message for message in messages if not message.body_loaded]
+    if not pending:
+        return messages
+    if service is None:
+        service = await google_async.build_service("gmail", "v1", token)
+
+    raw_messages = await batch_get_messages(service, [message.id for message in pending], format="full")
+    bodies = await google_async.run(message_bodies, raw_messages)
+    for message in pending:
+        if message.id in bodies:
+            message.body = bodies[message.id]
+            message.body_loaded = True
+    return messages
+
+
+async def iter_threads(service, query: str, limit: int) -> AsyncIterator[dict]:
+    """
+    Yields up to limit thread stubs matching query, following nextPageToken
+    """
+    page_token = None
+    remaining = limit
+    while remaining > 0:
+        results = await google_async.execute(
+            service.users().threads().list(
+                userId="me", q=query, maxResults=remaining, pageToken=page_token
+            )
+        )
+        threads = results.get("threads", [])[:remaining]
+        for thread in threads:
+            yield thread
+        remaining -= len(threads)
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return
+
+
+def parse_thread(thread_data) -> Tuple[List[GmailMessage], Set[str]]:
+    """
+    thread resource -> (messages, every sender/recipient address in the thread)
+    """
+    thread_msgs = []
+    thread_participants = set()
+
+    for msg in thread_data["messages"]:
+        headers = msg["payload"]["headers"]
         subject = next(
-            header["value"]
-            for header in msg["payload"]["headers"]
-            if header["name"].lower() == "subject"
+            (
+                header["value"]
+                for header in headers
+                if header["name"].lower() == "subject"
+            ),
+            "No Subject",
         )
         sender = next(
-            header["value"]
-            for header in msg["payload"]["headers"]
-            if header["name"].lower() == "from"
+            (
+                header["value"]
+                for header in headers
+                if header["name"].lower() == "from"
+            ),
+            "Unknown Sender",
+        )
+        recipients = next(
+            (
+                header["value"]
+                for header in headers
+                if header["name"].lower() == "to"
+            ),
+            "",
+        )
+        cc = next(
+            (
+                header["value"]
+                for header in headers
+                if header["name"].lower() == "cc"
+            ),
+            "",
         )
+        body = get_message_body(msg["payload"])
+
+        sender_email = extract_email(sender)
+        if recipients:
+            recipient_emails = [
+                extract_email(r.strip()) for r in recipients.split(",")
+            ]
+        else:
+            recipient_emails = []
+        if cc:
+            recipient_emails += [
+                extract_email(r.strip()) for r in cc.split(",")
+            ]
+        thread_participants.update([sender_email] + recipient_emails)
+
         try:
-            sender_email = sender.split("<")[1].split(">")[0]
-            sender = sender.split("<")[0].strip()
+            sender_name = sender.split("<")[0].strip()
         except Exception:
-            sender_email = sender
-            sender = sender
+            sender_name = sender
 
-        body = get_message_body(msg["payload"])
-
-        downloaded_messages.append(
+        thread_msgs.append(
             GmailMessage(
                 id=msg["id"],
                 threadId=msg["threadId"],
                 labels=msg["labelIds"],
                 snippet=msg["snippet"],
                 subject=subject,
-                sender=sender,
+                sender=sender_name,
                 sender_email=sender_email,
                 body=body,
+                body_loaded=True,
                 date=msg["internalDate"],
             )
         )
 
-    return downloaded_messages
+    return thread_msgs, thread_participants
+
+
+class ThreadCache:
+    """
+    Per-request cache of attendee thread listings and fetched threads
+    Concurrent lookups of the same key share one in-flight api call
+    """
+
+    def __init__(self, service, threads_per_attendee: int = 10):
+        self.service = service
+        self.threads_per_attendee = threads_per_attendee
+        self._attendee_threads: Dict[str, asyncio.Task] = {}
+        self._threads: Dict[str, asyncio.Task] = {}
+
+    @classmethod
+    async def create(cls, token: Optional[str] = None, threads_per_attendee: int = 10) -> "ThreadCache":
+        return cls(await google_async.build_service("gmail", "v1", token), threads_per_attendee)
+
+    async def _list_thread_ids(self, attendee: str) -> List[str]:
+        query = f"(to:{attendee} OR from:{attendee})"
+        return [thread["id"] async for thread in iter_threads(self.service, query, self.threads_per_attendee)]
+
+    async def _get_thread(self, thread_id: str) -> Tuple[List[GmailMessage], Set[str]]:
+        thread_data = await google_async.execute(
+            self.service.users().threads().get(userId="me", id=thread_id)
+        )
+        return await google_async.run(parse_thread, thread_data)
 
+    def attendee_thread_ids(self, attendee: str) -> "asyncio.Task[List[str]]":
+        if attendee not in self._attendee_threads:
+            self._attendee_threads[attendee] = asyncio.ensure_future(self._list_thread_ids(attendee))
+        return self._attendee_threads[attendee]
 
-def get_attendee_email_threads(
-    attendees: List[str], token: Optional[str] = None, threads_per_attendee=10
+    def thread(self, thread_id: str) -> "asyncio.Task[Tuple[List[GmailMessage], Set[str]]]":
+        if thread_id not in self._threads:
+            self._threads[thread_id] = asyncio.ensure_future(self._get_thread(thread_id))
+        return self._threads[thread_id]
+
+
+async def get_attendee_email_threads(
+    attendees: List[str],
+    token: Optional[str] = None,
+    threads_per_attendee=10,
+    cache: Optional[ThreadCache] = None,
 ):
-    service = get_google_api_service("gmail", "v1", token)
+    """
+    Threads shared by more than one attendee, each fetched once
+    Pass the same cache across calls to reuse listings and threads between events
+    """
+    if cache is None:
+        cache = await ThreadCache.create(token, threads_per_attendee)
 
     # attendees = ['pranaviyer2@gmail.com', 'donny@apeiron.life']
-    all_threads = []
+    attendees = list(dict.fromkeys(attendees))
+    attendee_thread_ids = await asyncio.gather(
+        *[cache.attendee_thread_ids(attendee) for attendee in attendees]
+    )
     thread_attendee_map = defaultdict(set)
-    for attendee in attendees:
-        query = f"(to:{attendee} OR from:{attendee})"
-        results = (
-            service.users()
-            .threads()
-            .list(userId="me", q=query, maxResults=threads_per_attendee)
-            .execute()
-        )
-        threads = results.get("threads", [])
-        all_threads.extend(threads)
-        for thread in threads:
-            thread_attendee_map[thread["id"]].add(attendee)
+    for attendee, thread_ids in zip(attendees, attendee_thread_ids):
+        for thread_id in thread_ids:
+            thread_attendee_map[thread_id].add(attendee)
 
     # get threads with multiple attendees
-    multi_attendee_threads = []
-    for thread in all_threads:
-        if len(thread_attendee_map[thread["id"]]) > 1:
-            thread_data = (
-                service.users().threads().get(userId="me", id=thread["id"]).execute()
-            )
-            thread_msgs = []
-            thread_participants = set()
-
-            for msg in thread_data["messages"]:
-                headers = msg["payload"]["headers"]
-                subject = next(
-                    (
-                        header["value"]
-                        for header in headers
-                        if header["name"].lower() == "subject"
-                    ),
-                    "No Subject",
-                )
-                sender = next(
-                    (
-                        header["value"]
-                        for header in headers
-                        if header["name"].lower() == "from"
-                    ),
-                    "Unknown Sender",
-                )
-                recipients = next(
-                    (
-                        header["value"]
-                        for header in headers
-                        if header["name"].lower() == "to"
-                    ),
-                    "",
-                )
-                cc = next(
-                    (
-                        header["value"]
-                        for header in headers
-                        if header["name"].lower() == "cc"
-                    ),
-                    "",
-                )
-                body = get_message_body(msg["payload"])
-
-                sender_email = extract_email(sender)
-                if recipients:
-                    recipient_emails = [
-                        extract_email(r.strip()) for r in recipients.split(",")
-                    ]
-                else:
-                    recipient_emails = []
-                if cc:
-                    recipient_emails += [
-                        extract_email(r.strip()) for r in cc.split(",")
-                    ]
-                thread_participants.update([sender_email] + recipient_emails)
-
-                try:
-                    sender_name = sender.split("<")[0].strip()
-                except Exception:
-                    sender_name = sender
-
-                thread_msgs.append(
-                    GmailMessage(
-                        id=msg["id"],
-                        threadId=msg["threadId"],
-                        labels=msg["labelIds"],
-                        snippet=msg["snippet"],
-                        subject=subject,
-                        sender=sender_name,
-                        sender_email=sender_email,
-                        body=body,
-                        date=msg["internalDate"],
-                    )
-                )
-
-            multi_attendee_threads.append(
-                {
-                    "messages": thread_msgs,
-                    "attendees": thread_attendee_map[thread["id"]],
-                    "all_participants": thread_participants,
-                }
-            )
+    multi_attendee_ids = [
+        thread_id for thread_id, thread_attendees in thread_attendee_map.items() if len(thread_attendees) > 1
+    ]
+    threads = await asyncio.gather(*[cache.thread(thread_id) for thread_id in multi_attendee_ids])
+    multi_attendee_threads = [
+        {
+            "messages": thread_msgs,
+            "attendees": thread_attendee_map[thread_id],
+            "all_participants": thread_participants,
+        }
+        for thread_id, (thread_msgs, thread_participants) in zip(multi_attendee_ids, threads)
+    ]
 
     # Sort threads by the number of attendees, in descending order
     multi_attendee_threads.sort(key=lambda x: len(x["attendees"]), reverse=True)
@@ -277,3 +481,4 @@ if __name__ == "__main__":
     #     print(f"Date: {msg.date}")
     #     print(f"Body: {msg.body[:200]}...")
     #     print("---")
+    pass
@@ -0,0 +1,164 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from pydantic import BaseModel, Field
+from googleapiclient.errors import HttpError
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from integrations import google_async
+from integrations.gmail import (
+    GmailMessage,
+    batch_get_messages,
+    load_message_bodies,
+    parse_messages,
+    stream_messages_since_yesterday,
+)
+from helpers import DEBUG, TTLCache, getenv
+
+SYNC_STATE_TTL = getenv("SYNC_STATE_TTL", 12 * 3600)  # idle users fall back to a full sync
+SYNC_STATE_USERS = getenv("SYNC_STATE_USERS", 256)  # states hold message bodies, bound the users kept
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded"]
+EXCLUDED_LABELS = {"DRAFT", "SPAM", "TRASH"}  # messages().list skips these too
+
+
+class MailboxSyncState(BaseModel):
+    """
+    Per-user gmail sync position and the local store of messages in the since-yesterday window
+    """
+
+    history_id: str
+    synced_at: datetime
+    messages: Dict[str, GmailMessage] = Field(default_factory=dict)
+
+
+_sync_states = TTLCache(maxsize=SYNC_STATE_USERS, ttl=SYNC_STATE_TTL)  # user_key -> MailboxSyncState
+_sync_locks = TTLCache(maxsize=4 * SYNC_STATE_USERS, ttl=SYNC_STATE_TTL)  # user_key -> asyncio.Lock
+
+
+def window_start_ms() -> int:
+    yesterday = datetime.now().replace(
+        hour=0, minute=0, second=0, microsecond=0
+    ) - timedelta(days=1)
+    return int(yesterday.timestamp() * 1000)
+
+
+async def full_sync(service, user_key: str, format: str = "full") -> AsyncIterator[GmailMessage]:
+    """
+    Streams the since-yesterday listing and stores it as the user's new sync state once complete
+    """
+    # read the history position before listing, anything newer is picked up by the next incremental sync
+    profile = await google_async.execute(service.users().getProfile(userId="me"))
+    state = MailboxSyncState(history_id=profile["historyId"], synced_at=datetime.now())
+    async for message in stream_messages_since_yesterday(service=service, format=format):
+        state.messages[message.id] = message
+        yield message.model_copy(deep=True)
+    _sync_states.set(user_key, state)
+
+
+async def list_history(service, start_history_id: str) -> Tuple[Set[str], Set[str], str]:
+    """
+    Follows history pages from start_history_id
+    Returns added message ids, removed message ids and the mailbox's current historyId
+    Raises HttpError 404 when start_history_id is too old for gmail to serve
+    """
+    added, removed = set(), set()
+    page_token = None
+    while True:
+        results = await google_async.execute(
+            service.users()
+            .history()
+            .list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=HISTORY_TYPES,
+                pageToken=page_token,
+            )
+        )
+        for record in results.get("history", []):
+            for added_message in record.get("messagesAdded", []):
+                message = added_message["message"]
+                if EXCLUDED_LABELS.isdisjoint(message.get("labelIds", [])):
+                    added.add(message["id"])
+            for deleted_message in record.get("messagesDeleted", []):
+                removed.add(deleted_message["message"]["id"])
+            for labeled_message in record.get("labelsAdded", []):
+                if not EXCLUDED_LABELS.isdisjoint(labeled_message.get("labelIds", [])):
+                    removed.add(labeled_message["message"]["id"])
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return added - removed, removed, results["historyId"]
+
+
+async def incremental_sync(service, state: MailboxSyncState, format: str = "full") -> MailboxSyncState:
+    added, removed, history_id = await list_history(service, state.history_id)
+    new_ids = [message_id for message_id in added if message_id not in state.messages]
+    raw_messages = await batch_get_messages(service, new_ids, format=format)
+    for message in await google_async.run(parse_messages, raw_messages):
+        state.messages[message.id] = message
+    for message_id in removed:
+        state.messages.pop(message_id, None)
+
+    cutoff = window_start_ms()
+    state.messages = {
+        message_id: message
+        for message_id, message in state.messages.items()
+        if int(message.date) >= cutoff
+    }
+    if format == "full":
+        # the store may hold messages synced as metadata
+        await load_message_bodies(list(state.messages.values()), service=service)
+    state.history_id = history_id
+    state.synced_at = datetime.now()
+    if DEBUG >= 1:
+        print(f"Incremental sync: {len(new_ids)} added, {len(removed)} removed", flush=True)
+    return state
+
+
+async def sync_messages_since_yesterday(
+    user_key: str, token: Optional[str] = None, service=None, format: str = "full"
+) -> AsyncIterator[GmailMessage]:
+    """
+    Same messages as stream_messages_since_yesterday, but only downloads messages added since the user's last sync
+    Falls back to a full resync when there is no state yet or the stored historyId has expired
+    """
+    if service is None:
+        service = await google_async.build_service("gmail", "v1", token)
+
+    async with _sync_locks.setdefault(user_key, asyncio.Lock()):
+        state = _sync_states.get(user_key)
+        if state is not None:
+            try:
+                state = await incremental_sync(service, state, format)
+                _sync_states.set(user_key, state)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                if DEBUG >= 1:
+                    print(f"History {state.history_id} expired, running full resync", flush=True)
+                state = None
+
+        if state is None:
+            async for message in full_sync(service, user_key, format):
+                yield message
+            return
+
+        # newest first, matching messages().list ordering
+        for message in sorted(state.messages.values(), key=lambda m: int(m.date), reverse=True):
+            yield message.model_copy(deep=True)
+
+
+def remember_bodies(user_key: str, messages: List[GmailMessage]):
+    """
+    Copy lazily loaded bodies back into the user's store so later syncs don't fetch them again
+    """
+    state = _sync_states.get(user_key)
+    if state is None:
+        return
+    for message in messages:
+        stored = state.messages.get(message.id)
+        if stored is not None and message.body_loaded and not stored.body_loaded:
+            stored.body = message.body
+            stored.body_loaded = True
@@ -0,0 +1,128 @@
+"""
+Non-blocking access to the google api client
+Requests are built on the event loop (no I/O) and executed on a bounded thread pool,
+each worker thread owning its own httplib2 transport since httplib2.Http is not thread-safe
+"""
+import asyncio, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, HttpRequest, build_http
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from integrations.auth import build_offline_service, get_google_api_service
+from fixtures import fixture_key, fixtures, normalize_uri
+from helpers import getenv
+
+GOOGLE_API_THREADS = getenv("GOOGLE_API_THREADS", 16)
+GOOGLE_API_RETRIES = getenv("GOOGLE_API_RETRIES", 2)  # retries 429/5xx with exponential backoff
+
+_executor = ThreadPoolExecutor(max_workers=GOOGLE_API_THREADS, thread_name_prefix="google-api")
+_local = threading.local()
+
+
+def _transport(http):
+    """
+    Swap the service's shared transport for this worker thread's own connection pool,
+    keeping the service's credentials
+    """
+    if not hasattr(_local, "http"):
+        _local.http = build_http()
+    if not isinstance(http, AuthorizedHttp):
+        return _local.http
+    return AuthorizedHttp(http.credentials, http=_local.http)
+
+
+async def run(fn, *args):
+    """
+    Run any blocking google client call on the api thread pool
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+async def build_service(service_name: str, version: str, token: Optional[str] = None):
+    if fixtures.replaying("google"):
+        return await run(build_offline_service, service_name, version)
+    return await run(get_google_api_service, service_name, version, token)
+
+
+def _execute(request: HttpRequest):
+    return request.execute(http=_transport(request.http), num_retries=GOOGLE_API_RETRIES)
+
+
+def request_key(request: HttpRequest) -> str:
+    return fixture_key(method=request.method, uri=normalize_uri(request.uri), body=request.body)
+
+
+def dump_error(error: HttpError) -> dict:
+    return {"status": error.resp.status, "content": error.content.decode("utf-8", "replace"), "uri": error.uri}
+
+
+def load_error(error: dict) -> HttpError:
+    return HttpError(httplib2.Response({"status": error["status"]}), error["content"].encode(), uri=error["uri"])
+
+
+async def execute(request: HttpRequest):
+    return await fixtures.call(
+        "google", request_key(request), lambda: run(_execute, request),
+        errors=(HttpError,), dump_error=dump_error, load_error=load_error, description=f"{request.method} {request.uri}",
+    )
+
+
+def _execute_batch(service, requests: List[Tuple[str, HttpRequest]], callback: Callable, batch_uri: Optional[str]):
+    batch = BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+    for request_id, request in requests:
+        batch.add(request, request_id=request_id)
+    batch.execute(http=_transport(service._http))
+
+
+async def execute_batch(
+    service, requests: List[Tuple[str, HttpRequest]], callback: Callable, batch_uri: Optional[str] = None
+):
+    """
+    One batch round trip for (request_id, request) pairs, callback(request_id, response, exception) per request
+    Outside of record/replay callbacks run on the worker thread. Recorded and replayed per request under the
+    same keys as execute, delivered in request order
+    """
+    if fixtures.replaying("google"):
+        await replay_batch(requests, callback)
+    elif fixtures.recording("google"):
+        await record_batch(service, requests, callback, batch_uri)
+    else:
+        await run(_execute_batch, service, requests, callback, batch_uri)
+
+
+async def record_batch(service, requests: List[Tuple[str, HttpRequest]], callback: Callable, batch_uri: Optional[str]):
+    results = {}
+
+    def collect(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    start = time.perf_counter()
+    await run(_execute_batch, service, requests, collect, batch_uri)
+    elapsed = time.perf_counter() - start
+    for request_id, request in requests:
+        response, exception = results[request_id]
+        if exception is not None:
+            fixtures.record("google", request_key(request), elapsed, error=dump_error(exception))
+        else:
+            fixtures.record("google", request_key(request), elapsed, value=response)
+        callback(request_id, response, exception)
+
+
+async def replay_batch(requests: List[Tuple[str, HttpRequest]], callback: Callable):
+    entries = [
+        (request_id, fixtures.lookup("google", request_key(request), f"{request.method} {request.uri}"))
+        for request_id, request in requests
+    ]
+    await asyncio.sleep(max((fixtures.delay(entry) for _, entry in entries), default=0))
+    for request_id, entry in entries:
+        if entry["error"] is not None:
+            callback(request_id, None, load_error(entry["error"]))
+        else:
+            callback(request_id, entry["value"], None)
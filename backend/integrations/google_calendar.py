@@ -1,11 +1,12 @@
-import sys
-from datetime import datetime, timedelta
+import sys, asyncio
+from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from googleapiclient.errors import HttpError
 
 sys.path.append("..")
-from integrations.auth import get_google_api_service
-from helpers import DEBUG
+from integrations import google_async
+from helpers import DEBUG, TTLCache, getenv
 
 
 class CalendarEvent(BaseModel):
@@ -20,8 +21,124 @@ class CalendarEvent(BaseModel):
     context: str = Field(default="")
 
 
-def get_today_events(token: Optional[str] = None, days_before=1, days_after=0):
-    service = get_google_api_service("calendar", "v3", token)
+class CalendarSyncState(BaseModel):
+    """
+    A calendar's syncToken and its locally merged events, keyed by event id
+    """
+
+    sync_token: str
+    time_min: str
+    time_max: str
+    events: Dict[str, dict] = Field(default_factory=dict)
+
+
+CALENDAR_STATE_TTL = getenv("CALENDAR_STATE_TTL", 12 * 3600)  # idle calendars fall back to a full sync
+CALENDAR_STATES = getenv("CALENDAR_STATES", 1024)  # calendars kept across all users
+
+_calendar_states = TTLCache(maxsize=CALENDAR_STATES, ttl=CALENDAR_STATE_TTL)  # (user_key, calendar_id) -> CalendarSyncState
+_calendar_locks = TTLCache(maxsize=CALENDAR_STATES, ttl=CALENDAR_STATE_TTL)  # user_key -> asyncio.Lock
+
+
+def event_time(value: dict) -> datetime:
+    """
+    start/end of an event as an aware datetime, all-day dates are taken as UTC midnight
+    """
+    if "dateTime" in value:
+        return datetime.fromisoformat(value["dateTime"].replace("Z", "+00:00"))
+    return datetime.fromisoformat(value["date"]).replace(tzinfo=timezone.utc)
+
+
+def in_window(event: dict, time_min: str, time_max: str) -> bool:
+    window_start = datetime.fromisoformat(time_min.replace("Z", "+00:00"))
+    window_end = datetime.fromisoformat(time_max.replace("Z", "+00:00"))
+    return event_time(event["end"]) > window_start and event_time(event["start"]) < window_end
+
+
+async def list_events(service, **params) -> Tuple[List[dict], Optional[str]]:
+    """
+    Follows every page of events().list, returns the events and the nextSyncToken from the last page
+    """
+    events = []
+    page_token = None
+    while True:
+        results = await google_async.execute(
+            service.events().list(singleEvents=True, pageToken=page_token, **params)
+        )
+        events += results.get("items", [])
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return events, results.get("nextSyncToken")
+
+
+async def sync_calendar_events(service, calendar_id: str, time_min: str, time_max: str, user_key: str) -> List[dict]:
+    """
+    Events of one calendar in the window. After the first call only changed events are downloaded;
+    a new window or an expired syncToken (410) triggers a full sync
+    """
+    key = (user_key, calendar_id)
+    state = _calendar_states.get(key)
+    if state is not None and (state.time_min, state.time_max) == (time_min, time_max):
+        try:
+            # changes are reported for events anywhere in the calendar, filter to the window after merging
+            changes, sync_token = await list_events(service, calendarId=calendar_id, syncToken=state.sync_token)
+            for event in changes:
+                if event.get("status") == "cancelled":
+                    state.events.pop(event["id"], None)
+                else:
+                    state.events[event["id"]] = event
+            state.sync_token = sync_token or state.sync_token
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            state = None
+    else:
+        state = None
+
+    if state is None:
+        events, sync_token = await list_events(
+            service, calendarId=calendar_id, timeMin=time_min, timeMax=time_max
+        )
+        state = CalendarSyncState(
+            sync_token=sync_token or "",
+            time_min=time_min,
+            time_max=time_max,
+            events={event["id"]: event for event in events},
+        )
+
+    if state.sync_token:
+        _calendar_states.set(key, state)
+    else:
+        _calendar_states.pop(key, None)
+    state.events = {
+        event_id: event for event_id, event in state.events.items() if in_window(event, time_min, time_max)
+    }
+    return sorted(state.events.values(), key=lambda event: event_time(event["start"]))
+
+
+async def get_calendar_events(service, calendar_id: str, time_min: str, time_max: str, user_key: Optional[str] = None) -> List[dict]:
+    if user_key:
+        return await sync_calendar_events(service, calendar_id, time_min, time_max, user_key)
+    events, _ = await list_events(
+        service, calendarId=calendar_id, timeMin=time_min, timeMax=time_max, orderBy="startTime"
+    )
+    return events
+
+
+async def get_calendar_timezone(token: Optional[str] = None) -> str:
+    """
+    IANA timezone from the user's calendar settings, e.g. America/New_York
+    """
+    service = await google_async.build_service("calendar", "v3", token)
+    setting = await google_async.execute(service.settings().get(setting="timezone"))
+    return setting.get("value", "UTC")
+
+
+async def get_today_events(token: Optional[str] = None, days_before=1, days_after=0, user_key: Optional[str] = None):
+    """
+    Events across all of the user's calendars, each calendar queried concurrently
+    user_key enables syncToken based incremental updates between calls
+    """
+    service = await google_async.build_service("calendar", "v3", token)
 
     # Get the start and end of the desired date range
     today = datetime.now().date()
@@ -29,35 +146,35 @@ def get_today_events(token: Optional[str] = None, days_before=1, days_after=0):
     end_date = today + timedelta(
         days=days_after + 2
     )
-    start = datetime.combine(start_date, datetime.min.time()).isoformat() + "Z"
-    end = datetime.combine(end_date, datetime.min.time()).isoformat() + "Z"
+    time_min = datetime.combine(start_date, datetime.min.time()).isoformat() + "Z"
+    time_max = datetime.combine(end_date, datetime.min.time()).isoformat() + "Z"
 
     # Retrieve all calendars
-    calendar_list = service.calendarList().list().execute()
+    calendar_list = await google_async.execute(service.calendarList().list())
+    calendar_ids = [calendar_entry['id'] for calendar_entry in calendar_list.get('items', [])]
 
-    today_events: List[CalendarEvent] = []
-    for calendar_entry in calendar_list.get('items', []):
-        events_result = (
-            service.events()
-            .list(
-                calendarId=calendar_entry['id'],
-                timeMin=start,
-                timeMax=end,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
+    async def all_calendar_events():
+        return await asyncio.gather(
+            *[get_calendar_events(service, calendar_id, time_min, time_max, user_key) for calendar_id in calendar_ids]
         )
-        events = events_result.get("items", [])
 
+    # anonymous calls keep no state, so there is nothing to serialize
+    if user_key:
+        async with _calendar_locks.setdefault(user_key, asyncio.Lock()):
+            calendar_events = await all_calendar_events()
+    else:
+        calendar_events = await all_calendar_events()
+
+    today_events: List[CalendarEvent] = []
+    for events in calendar_events:
         for event in events:
             start = event["start"].get("dateTime", event["start"].get("date"))
             end = event["end"].get("dateTime", event["end"].get("date"))
             today_events.append(
                 CalendarEvent(
-                    summary=event["summary"],
-                    creator=event.get("creator").get("email", ""),
-                    organizer=event.get("organizer").get("email", ""),
+                    summary=event.get("summary", ""),
+                    creator=event.get("creator", {}).get("email", ""),
+                    organizer=event.get("organizer", {}).get("email", ""),
                     attendees=[
                         attendee.get("email", "") for attendee in event.get("attendees", [])
                     ],
@@ -68,40 +185,8 @@ def get_today_events(token: Optional[str] = None, days_before=1, days_after=0):
                 )
             )
 
-    # events_result = (
-    #     service.events()
-    #     .list(
-    #         calendarId="primary",
-    #         timeMin=start,
-    #         timeMax=end,
-    #         singleEvents=True,
-    #         orderBy="startTime",
-    #     )
-    #     .execute()
-    # )
-    # events = events_result.get("items", [])
-
-    # today_events: List[CalendarEvent] = []
-    # for event in events:
-    #     start = event["start"].get("dateTime", event["start"].get("date"))
-    #     end = event["end"].get("dateTime", event["end"].get("date"))
-    #     today_events.append(
-    #         CalendarEvent(
-    #             summary=event["summary"],
-    #             creator=event.get("creator").get("email", ""),
-    #             organizer=event.get("organizer").get("email", ""),
-    #             attendees=[
-    #                 attendee.get("email", "") for attendee in event.get("attendees", [])
-    #             ],
-    #             start=start,
-    #             end=end,
-    #             description=event.get("description", ""),
-    #             location=event.get("location", ""),
-    #         )
-    #     )
-
     if DEBUG >= 1:
-        print(f"Found {len(events)} events for today.", flush=True)
+        print(f"Found {len(today_events)} events for today.", flush=True)
         for event in today_events:
             print(f"Summary: {event.summary}", flush=True)
             print(f"Creator: {event.creator}", flush=True)
@@ -117,4 +202,4 @@ def get_today_events(token: Optional[str] = None, days_before=1, days_after=0):
 
 
 if __name__ == "__main__":
-    events = get_today_events()
+    events = asyncio.run(get_today_events())
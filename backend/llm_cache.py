@@ -0,0 +1,149 @@
+"""
+Content-addressed cache for anthropic responses, used by llm_gateway
+Keys hash the model, messages and every other request parameter (plus the response model's schema for
+instructor calls). An in-memory LRU sits in front of an optional sqlite file, both evicted by size in bytes.
+"""
+import asyncio, hashlib, json, sqlite3, threading, time
+from collections import Counter, OrderedDict
+from typing import Any, Optional, Type
+from anthropic.types import Message
+from pydantic import BaseModel
+
+from helpers import getenv
+
+LLM_CACHE_MEMORY_BYTES = getenv("LLM_CACHE_MEMORY_BYTES", 64 * 1024 * 1024)
+LLM_CACHE_PATH = getenv("LLM_CACHE_PATH", "")  # sqlite file, disk tier disabled when empty
+LLM_CACHE_DISK_BYTES = getenv("LLM_CACHE_DISK_BYTES", 512 * 1024 * 1024)
+
+
+def make_key(**parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def request_key(response_model: Optional[Type[BaseModel]] = None, **kwargs) -> str:
+    schema = None if response_model is None else [response_model.__name__, response_model.model_json_schema()]
+    return make_key(request=kwargs, response_model=schema)
+
+
+class MemoryTier:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> int:
+        """
+        Returns the number of entries evicted to make room
+        """
+        evicted = 0
+        with self._lock:
+            if key in self._data:
+                self.bytes -= len(self._data.pop(key))
+            self._data[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes and len(self._data) > 1:
+                _, old = self._data.popitem(last=False)
+                self.bytes -= len(old)
+                evicted += 1
+        return evicted
+
+
+class DiskTier:
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return row[0]
+
+    def set(self, key: str, value: bytes) -> int:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            evicted = 0
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+            while total > self.max_bytes:
+                row = self._db.execute("SELECT key, size FROM llm_cache ORDER BY accessed LIMIT 1").fetchone()
+                if row is None or row[0] == key:
+                    break
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (row[0],))
+                total -= row[1]
+                evicted += 1
+            self._db.commit()
+            return evicted
+
+
+class LLMCache:
+    def __init__(
+        self,
+        memory_bytes: int = LLM_CACHE_MEMORY_BYTES,
+        path: str = LLM_CACHE_PATH,
+        disk_bytes: int = LLM_CACHE_DISK_BYTES,
+    ):
+        self.memory = MemoryTier(memory_bytes)
+        self.disk = DiskTier(path, disk_bytes) if path else None
+        self.stats: Counter = Counter()  # memory_hits, disk_hits, misses, evictions
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+        if self.disk is not None:
+            value = await asyncio.to_thread(self.disk.get, key)
+            if value is not None:
+                self.stats["disk_hits"] += 1
+                self.stats["evictions"] += self.memory.set(key, value)
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: bytes):
+        self.stats["evictions"] += self.memory.set(key, value)
+        if self.disk is not None:
+            self.stats["evictions"] += await asyncio.to_thread(self.disk.set, key, value)
+
+    async def get_value(self, key: str) -> Any:
+        value = await self.get(key)
+        return None if value is None else json.loads(value)
+
+    async def set_value(self, key: str, value: Any):
+        await self.set(key, json.dumps(value).encode())
+
+    def report(self):
+        lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hit_rate = (lookups - self.stats["misses"]) / lookups if lookups else 0.0
+        print(
+            f"LLM cache: {hit_rate:.0%} hit rate ({self.stats['memory_hits']} memory, {self.stats['disk_hits']} disk, "
+            f"{self.stats['misses']} misses, {self.stats['evictions']} evictions), {self.memory.bytes} bytes in memory",
+            flush=True,
+        )
+
+
+def free(message: Message) -> Message:
+    return message.model_copy(update={"usage": message.usage.model_copy(update={"input_tokens": 0, "output_tokens": 0})})
+
+
+llm_cache = LLMCache()
@@ -0,0 +1,208 @@
+"""
+Process-wide gateway for every anthropic call
+One pooled AsyncAnthropic client, a concurrency limit, request and token per-minute buckets,
+jittered exponential backoff on 429/529/5xx, and the response cache in front of it all
+"""
+import asyncio, json, os, random, time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional, Tuple, Type
+import anthropic
+from anthropic import AsyncAnthropic
+from anthropic.types import Message
+from instructor import from_anthropic, Mode
+from pydantic import BaseModel
+
+from llm_cache import LLMCache, free, llm_cache, request_key
+from tokens import estimate_tokens
+from fixtures import fixtures
+from helpers import DEBUG, getenv
+
+LLM_CONCURRENCY = getenv("LLM_CONCURRENCY", 16)  # requests in flight
+LLM_REQUESTS_PER_MINUTE = getenv("LLM_REQUESTS_PER_MINUTE", 50)
+LLM_TOKENS_PER_MINUTE = getenv("LLM_TOKENS_PER_MINUTE", 40_000)  # input tokens
+LLM_MAX_RETRIES = getenv("LLM_MAX_RETRIES", 5)
+LLM_MAX_BACKOFF = getenv("LLM_MAX_BACKOFF", 30.0)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504, 529}
+
+
+class TokenBucket:
+    """
+    Refills continuously at per_minute / 60 per second up to per_minute
+    Waiters are served in order; the level may go negative when actual usage exceeds the estimate
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.level < amount:
+                await asyncio.sleep((amount - self.level) / self.rate)
+                self._refill()
+            self.level -= amount
+
+    def adjust(self, amount: float):
+        """
+        Settle the difference between the estimate and what the response reported
+        """
+        self._refill()
+        self.level -= amount
+
+
+def request_tokens(kwargs: dict) -> int:
+    return estimate_tokens(json.dumps([kwargs.get("system", ""), kwargs.get("messages", [])], default=str))
+
+
+def retry_delay(error: anthropic.APIStatusError, attempt: int) -> float:
+    retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+    if retry_after is not None:
+        try:
+            return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            pass
+    return random.uniform(0.5, 1.0) * min(LLM_MAX_BACKOFF, 2**attempt)
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        concurrency: int = LLM_CONCURRENCY,
+        requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+        max_retries: int = LLM_MAX_RETRIES,
+        cache: Optional[LLMCache] = llm_cache,
+    ):
+        self.concurrency = concurrency
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.cache = cache
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._client = None
+        self._instructor = None
+
+    @property
+    def client(self) -> AsyncAnthropic:
+        if self._client is None:
+            # retries are handled here so they respect the rate limits
+            self._client = AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"), max_retries=0)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+        self._instructor = None
+
+    @property
+    def instructor(self):
+        if self._instructor is None:
+            self._instructor = from_anthropic(client=self.client, mode=Mode.ANTHROPIC_JSON)
+        return self._instructor
+
+    @instructor.setter
+    def instructor(self, client):
+        self._instructor = client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    @asynccontextmanager
+    async def _slot(self, estimated_tokens: int):
+        async with self.semaphore:
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimated_tokens)
+            yield
+
+    async def _call(self, fn, kwargs: dict):
+        estimated = request_tokens(kwargs)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._slot(estimated):
+                    return await fn()
+            except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+                status = getattr(e, "status_code", None)
+                if attempt == self.max_retries or (status is not None and status not in RETRYABLE_STATUSES):
+                    raise
+                delay = retry_delay(e, attempt) if status is not None else random.uniform(0.5, 1.0) * 2**attempt
+                if DEBUG >= 1:
+                    print(f"LLM request failed ({status or type(e).__name__}), retrying in {delay:.1f}s", flush=True)
+                await asyncio.sleep(delay)
+
+    def _settle(self, kwargs: dict, usage):
+        self.tokens.adjust(usage.input_tokens - request_tokens(kwargs))
+
+    async def create(self, **kwargs) -> Message:
+        """
+        messages.create through the cache and limits
+        Cache hits report zero usage, nothing was spent on them
+        """
+        key = request_key(**kwargs)
+        if self.cache is not None:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return free(Message.model_validate_json(cached))
+
+        async def call():
+            return await fixtures.call(
+                "anthropic", key, lambda: self.client.messages.create(**kwargs),
+                dump=lambda response: response.model_dump(mode="json"), load=Message.model_validate,
+            )
+
+        response = await self._call(call, kwargs)
+        self._settle(kwargs, response.usage)
+        if self.cache is not None:
+            await self.cache.set(key, response.model_dump_json().encode())
+        return response
+
+    async def create_with_completion(self, response_model: Type[BaseModel], **kwargs) -> Tuple[BaseModel, Message]:
+        """
+        instructor structured output through the cache and limits
+        """
+        key = request_key(response_model=response_model, **kwargs)
+        if self.cache is not None:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                entry = json.loads(cached)
+                return response_model.model_validate(entry["response"]), free(Message.model_validate(entry["completion"]))
+
+        async def call():
+            return await fixtures.call(
+                "anthropic", key,
+                lambda: self.instructor.messages.create_with_completion(response_model=response_model, **kwargs),
+                dump=lambda result: [result[0].model_dump(mode="json"), result[1].model_dump(mode="json")],
+                load=lambda value: (response_model.model_validate(value[0]), Message.model_validate(value[1])),
+            )
+
+        response, completion = await self._call(call, kwargs)
+        self._settle(kwargs, completion.usage)
+        if self.cache is not None:
+            entry = {"response": response.model_dump(mode="json"), "completion": completion.model_dump(mode="json")}
+            await self.cache.set(key, json.dumps(entry).encode())
+        return response, completion
+
+    @asynccontextmanager
+    async def stream(self, **kwargs) -> AsyncIterator:
+        """
+        messages.stream under the limits, the concurrency slot is held until the stream closes
+        Not cached, recorded or retried once text has started flowing
+        """
+        async with self._slot(request_tokens(kwargs)):
+            async with self.client.messages.stream(**kwargs) as stream:
+                yield stream
+
+
+llm = LLMGateway()
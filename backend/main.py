@@ -1,18 +1,39 @@
-import pickle, os
+import pickle, os, json, asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
 from fastapi import HTTPException, Header, Depends
 from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
 
 from users import get_current_user, CurrentUser
 from users import router as users_router
 from daily_learning import router as daily_learning_router
-from make_briefly import get_email_data, get_event_related_emails, EmailResponse, CalendarResponse
-from make_briefless import generate_news_summary
+from make_briefly import get_email_data, get_event_related_emails, stream_email_data, replay_email_data
+from make_briefly import EmailResponse, CalendarResponse
+from make_briefless import NoResearch, get_news_summary
+from integrations.auth import preload_discovery_documents
+from briefings import create_briefing_table, precomputed_briefing, run_scheduler
+from browser_pool import browser_pool
+from http_session import close_session
 from helpers import DEV
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    preload_discovery_documents()  # parse gmail/calendar/people discovery documents once at startup
+    scheduler = None
+    if DEV < 1:
+        await asyncio.to_thread(create_briefing_table)
+        scheduler = asyncio.create_task(run_scheduler())
+    yield
+    if scheduler is not None:
+        scheduler.cancel()
+    await close_session()
+    await asyncio.to_thread(browser_pool.close)
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(users_router)
 app.include_router(daily_learning_router)
 
@@ -49,17 +70,50 @@ async def get_user_header(authorization: str = Header(None)):
 async def get_emails(user: CurrentUser = Depends(get_user_header)):
     if DEV >= 1:
         email_data: EmailResponse = await load_or_save_pickle('email_data.pickle', get_email_data)
-    else:
-        email_data = await get_email_data(token=user.google_token)
+        return jsonable_encoder(email_data)
+    # precomputed by the briefing scheduler, served once, later visits get live data
+    briefing = await precomputed_briefing(user.email, "emails")
+    if briefing is not None:
+        return briefing
+    email_data = await get_email_data(token=user.google_token, user_key=user.email)
     return jsonable_encoder(email_data)
 
 
+async def email_events(user: CurrentUser):
+    if DEV >= 1:
+        email_data: EmailResponse = await load_or_save_pickle('email_data.pickle', get_email_data)
+        events = replay_email_data(email_data)
+    else:
+        # same precomputed briefing as /api/get-emails, whichever endpoint asks first gets it
+        briefing = await precomputed_briefing(user.email, "emails")
+        if briefing is not None:
+            events = replay_email_data(EmailResponse.model_validate(briefing))
+        else:
+            events = stream_email_data(token=user.google_token, user_key=user.email)
+    async for event in events:
+        if event.event == "done":
+            yield {"event": "done", "data": json.dumps(jsonable_encoder(event.totals))}
+        else:
+            yield {"event": event.event, "data": json.dumps(jsonable_encoder(event.email))}
+
+
+@app.get("/api/get-emails/stream")
+async def get_emails_stream(user: CurrentUser = Depends(get_user_header)):
+    """
+    Server-sent events: classified and summarized per email as each is ready, then done with the totals
+    """
+    return EventSourceResponse(email_events(user), media_type="text/event-stream")
+
+
 @app.get("/api/get-calendar")
 async def get_calendar(user: CurrentUser = Depends(get_user_header)):
     if DEV >= 1:
         calendar_data: CalendarResponse = await load_or_save_pickle('calendar_events.pickle', get_event_related_emails)
-    else:
-        calendar_data = await get_event_related_emails(token=user.google_token, self_email=user.email)
+        return jsonable_encoder(calendar_data)
+    briefing = await precomputed_briefing(user.email, "calendar")
+    if briefing is not None:
+        return briefing
+    calendar_data = await get_event_related_emails(token=user.google_token, self_email=user.email)
     return jsonable_encoder(calendar_data)
 
 
@@ -70,7 +124,10 @@ class NewsRequest(BaseModel):
 @app.post("/api/less-brief")
 async def get_less_brief(request: NewsRequest):
     # news emails search the web
-    briefless = await generate_news_summary(request.clickedSummary)
+    try:
+        briefless = await get_news_summary(request.clickedSummary)
+    except NoResearch as e:
+        raise HTTPException(status_code=503, detail=f"Couldn't research this story right now: {e}")
     return {"content": briefless}
 
 
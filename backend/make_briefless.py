@@ -1,90 +1,111 @@
-import os, asyncio, aiohttp
+import os, asyncio, aiohttp, random, re
+from collections import Counter
 from pydantic import BaseModel
-from typing import Optional, List, Tuple
-import anthropic
+from typing import Dict, Optional, List, Tuple
 from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import TimeoutException, WebDriverException
-from webdriver_manager.chrome import ChromeDriverManager
-import concurrent.futures
 
-from helpers import DEBUG
+from helpers import DEBUG, TTLCache, getenv
+from browser_pool import BROWSER_PAGE_TIMEOUT, browser_executor, browser_pool
+from fixtures import fixture_key, fixtures
+from http_session import get_session
+from page_content import build_research
+from page_fetch import fetch_page, needs_browser
+from llm_gateway import llm
 from make_briefly import anthropic_cost
 
 
+DEEP_DIVE_TTL = getenv("DEEP_DIVE_TTL", 6 * 3600)  # seconds a deep dive is reused, news moves on
+DEEP_DIVE_CACHE_SIZE = getenv("DEEP_DIVE_CACHE_SIZE", 512)
+
+_deep_dives = TTLCache(maxsize=DEEP_DIVE_CACHE_SIZE, ttl=DEEP_DIVE_TTL)
+_in_flight: Dict[str, asyncio.Task] = {}
+deep_dive_stats: Counter = Counter()  # hits, coalesced, misses
+
+SEARCH_CACHE_TTL = getenv("SEARCH_CACHE_TTL", 3600)
+SEARCH_CACHE_SIZE = getenv("SEARCH_CACHE_SIZE", 1024)
+SEARCH_TIMEOUT = getenv("SEARCH_TIMEOUT", 10.0)
+SEARCH_MAX_RETRIES = getenv("SEARCH_MAX_RETRIES", 3)  # 429/5xx and network errors, with jittered backoff
+SEARCH_MAX_BACKOFF = getenv("SEARCH_MAX_BACKOFF", 8.0)
+SEARCH_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+_searches = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+search_stats: Counter = Counter()  # requests (quota used), hits, misses, errors
+
+
+class NoResearch(Exception):
+    """
+    Search or page fetching came back empty, likely transient; nothing is summarized or cached
+    """
+
+
 class SearchResult(BaseModel):
     title: str
     href: str
     body: Optional[str]
 
 
-def setup_driver():
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--disable-extensions")
-    chrome_options.add_argument("--disable-images")
-    chrome_options.page_load_strategy = "eager"
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=chrome_options)
-    return driver
-
-
 def scrape_url(url):
     """
     grab 1 html page
     """
-    driver = setup_driver()
+    return fixtures.call_sync("pages", fixture_key(url=url), lambda: _scrape_url(url), description=url)
+
+
+def _scrape_url(url):
     try:
-        driver.set_page_load_timeout(10)
-        driver.get(url)
+        with browser_pool.driver() as driver:
+            driver.get(url)
 
-        # Wait for the body to be present
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.TAG_NAME, "body"))
-        )
+            # Wait for the body to be present
+            WebDriverWait(driver, BROWSER_PAGE_TIMEOUT).until(
+                EC.presence_of_element_located((By.TAG_NAME, "body"))
+            )
 
-        return driver.page_source
+            return driver.page_source
     except (TimeoutException, WebDriverException) as e:
         print(f"Error scraping {url}: {str(e)}")
         return None
-    finally:
-        driver.quit()
 
 
-def scrape_urls(urls, max_workers=5):
+async def scrape_urls(urls: List[str]) -> Dict[str, str]:
     """
-    selenium scraper to download html pages
+    selenium scraper to download html pages, on the browser threads
     """
     if DEBUG >= 1:
         print(f"Scraping Web", flush=True)
 
+    loop = asyncio.get_running_loop()
+    pages = await asyncio.gather(
+        *[loop.run_in_executor(browser_executor, scrape_url, url) for url in urls], return_exceptions=True
+    )
     results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_url = {executor.submit(scrape_url, url): url for url in urls}
-        for future in concurrent.futures.as_completed(future_to_url):
-            url = future_to_url[future]
-            try:
-                html = future.result()
-                if html:
-                    results[url] = html
-            except Exception as e:
-                import traceback
-                traceback.print_exc()
-                print(f"Error processing {url}: {str(e)}")
+    for url, html in zip(urls, pages):
+        if isinstance(html, Exception):
+            print(f"Error processing {url}: {str(html)}")
+        elif html:
+            results[url] = html
     return results
 
 
-def generate_search_query(
-    client: anthropic.Anthropic, summary: str
-) -> Tuple[str, float]:
+async def fetch_pages(urls: List[str]) -> Dict[str, str]:
+    """
+    Pages over http concurrently, only JS shells go through the browser pool
+    """
+    pages = dict(zip(urls, await asyncio.gather(*[fetch_page(url) for url in urls])))
+    # parses every page, keep it off the event loop like extraction
+    rendered = await asyncio.to_thread(lambda: [url for url, html in pages.items() if needs_browser(html)])
+    if rendered:
+        if DEBUG >= 1:
+            print(f"Rendering {len(rendered)}/{len(urls)} pages in the browser", flush=True)
+        pages.update(await scrape_urls(rendered))
+    return {url: pages[url] for url in urls if pages.get(url)}
+
+
+async def generate_search_query(summary: str) -> Tuple[str, float]:
     """
     snippet of text from a newsletter -> google search query
     """
@@ -96,7 +117,7 @@ def generate_search_query(
     <snippet>
     {summary}
     </snippet>"""
-    response = client.messages.create(
+    response = await llm.create(
         messages=[
             {"role": "user", "content": prompt},
             {"role": "assistant", "content": "<search_query>"},
@@ -112,20 +133,35 @@ def generate_search_query(
     return response.content[0].text.strip(), cost
 
 
+def search_delay(retry_after: Optional[str], attempt: int) -> float:
+    try:
+        return float(retry_after) + random.uniform(0, 1)
+    except (TypeError, ValueError):
+        return random.uniform(0.5, 1.0) * min(SEARCH_MAX_BACKOFF, 2**attempt)
+
+
 async def async_google_search(
     query: str, num_results=10
-) -> Optional[List[SearchResult]]:
+) -> List[SearchResult]:
     """
     google search api
     num_results max is 10
+    results are cached per query for SEARCH_CACHE_TTL, failures return [] and are not cached
     """
+    cache_key = (query, num_results)
+    cached = _searches.get(cache_key)
+    if cached is not None:
+        search_stats["hits"] += 1
+        return cached
+    search_stats["misses"] += 1
+
     if DEBUG >= 1:
         print(f"Searching Google", flush=True)
 
     api_key = os.environ.get("GOOGLE_SEARCH_API_KEY")
     cse_id = os.environ.get("GOOGLE_SEARCH_CSE_ID")
 
-    if not api_key or not cse_id:
+    if (not api_key or not cse_id) and not fixtures.replaying("search"):
         raise ValueError("GOOGLE_SEARCH_API_KEY and GOOGLE_SEARCH_CSE_ID must be set")
 
     search_url = "https://www.googleapis.com/customsearch/v1/"
@@ -136,36 +172,50 @@ async def async_google_search(
         "num": num_results,
     }
 
-    async def fetch_results():
-        async with aiohttp.ClientSession() as session:
-            async with session.get(search_url, params=params) as response:
-                if response.status == 200:
-                    search_results = await response.json()
-                    items = search_results.get("items", [])
-                    results = [
-                        SearchResult(
-                            title=item["title"],
-                            href=item["link"],
-                            body=item.get("snippet", ""),
-                        )
-                        for item in items
-                    ]
-                    return results if results else []
-                elif response.status == 400:
-                    error_content = await response.text()
-                    print(
-                        f"Error 400: Bad Request. Content: {error_content}", flush=True
-                    )
-                    return []
-                else:
-                    print(f"Error: {response.status}")
-                    return []
-
-    results = await fetch_results()
-    if not results:
-        print("Retrying search due to empty results...", flush=True)
-        results = await fetch_results()
-
+    async def search() -> Optional[List[SearchResult]]:
+        """
+        None once retries are exhausted or on a non-retryable error (bad request, daily quota spent)
+        """
+        timeout = aiohttp.ClientTimeout(total=SEARCH_TIMEOUT)
+        for attempt in range(SEARCH_MAX_RETRIES + 1):
+            search_stats["requests"] += 1  # every request counts against the quota
+            status, retry_after = None, None
+            try:
+                async with get_session().get(search_url, params=params, timeout=timeout) as response:
+                    if response.status == 200:
+                        search_results = await response.json()
+                        return [
+                            SearchResult(
+                                title=item["title"],
+                                href=item["link"],
+                                body=item.get("snippet", ""),
+                            )
+                            for item in search_results.get("items", [])
+                        ]
+                    status, retry_after = response.status, response.headers.get("Retry-After")
+                    error = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = f"{type(e).__name__} {e}"
+            if attempt == SEARCH_MAX_RETRIES or (status is not None and status not in SEARCH_RETRYABLE_STATUSES):
+                search_stats["errors"] += 1
+                print(f"Search failed ({status}): {error}", flush=True)
+                return None
+            delay = search_delay(retry_after, attempt)
+            if DEBUG >= 1:
+                print(f"Search failed ({status or error}), retrying in {delay:.1f}s", flush=True)
+            await asyncio.sleep(delay)
+
+    results = await fixtures.call(
+        "search", fixture_key(query=query, num=num_results), search,
+        dump=lambda results: None if results is None else [result.model_dump() for result in results],
+        load=lambda results: None if results is None else [SearchResult(**result) for result in results],
+        description=query,
+    )
+    if DEBUG >= 1:
+        print(f"Search stats: {dict(search_stats)}", flush=True)
+    if results is None:
+        return []
+    _searches.set(cache_key, results)
     return results
 
 
@@ -186,16 +236,16 @@ def extract_text_from_html(html):
     return text
 
 
-def summarize_search_results(
-    client, original_summary: str, search_results: List[str]
+async def summarize_search_results(
+    original_summary: str, search_results: List[str]
 ) -> Tuple[str, float]:
     """
-    10 pages of cleaned html -> summary
+    most relevant passages of each page (page_content.build_research) -> summary
     """
     if DEBUG >= 1:
         print(f"Summarizing Search Results")
 
-    research = "".join([f"\nPage {i+1}:\n" + s for i, s in enumerate(search_results)])
+    research = "".join([f"\nPage {i+1}:\n" + s for i, s in enumerate(s for s in search_results if s)])
     if DEBUG >= 1:
         print(f"Research: {research}", flush=True)
     prompt = f"""
@@ -210,7 +260,7 @@ def summarize_search_results(
     {research}
     </research>"""
 
-    response = client.messages.create(
+    response = await llm.create(
         messages=[
             {"role": "user", "content": prompt},
             {"role": "assistant", "content": "<comprehensive_summary>"},
@@ -227,17 +277,22 @@ def summarize_search_results(
 async def generate_news_summary(email_summary: str):
     """
     given some information on a topic, go to the web and get more information for the user
+    search, fetch, extraction and summary never block the event loop
     """
-    client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
-    # search_query, cost = generate_search_query(client, email_summary)
+    # search_query, cost = await generate_search_query(email_summary)
     search_query = email_summary
     search_results: List[SearchResult] = await async_google_search(query=search_query)
     # only grab top 5
     search_results = search_results[:5]
-    web_pages = scrape_urls(urls=[s.href for s in search_results])
-    search_results_text = [extract_text_from_html(web_page) for web_page in web_pages]
-    final_summary, cost2 = summarize_search_results(
-        client, email_summary, search_results_text
+    if not search_results:
+        raise NoResearch("No search results")
+    web_pages = await fetch_pages([s.href for s in search_results])
+    # html parsing is CPU bound, keep it off the event loop
+    search_results_text = await asyncio.to_thread(build_research, email_summary, list(web_pages.values()))
+    if not any(search_results_text):
+        raise NoResearch("No page text")
+    final_summary, cost2 = await summarize_search_results(
+        email_summary, search_results_text
     )
     print(f"Total Cost: {cost2}", flush=True)
     if DEBUG >= 1:
@@ -245,6 +300,40 @@ async def generate_news_summary(email_summary: str):
     return final_summary
 
 
+def normalize_summary(summary: str) -> str:
+    return re.sub(r"\s+", " ", summary).strip().strip(".,;:!?-").lower()
+
+
+async def get_news_summary(email_summary: str) -> str:
+    """
+    generate_news_summary cached per normalized summary, with concurrent identical requests
+    sharing one computation. The computation is shielded, a caller disconnecting doesn't cancel it for the others
+    Failures, NoResearch included, reach every waiter and are not cached
+    """
+    key = normalize_summary(email_summary)
+    cached = _deep_dives.get(key)
+    if cached is not None:
+        deep_dive_stats["hits"] += 1
+        return cached
+
+    task = _in_flight.get(key)
+    if task is None:
+        deep_dive_stats["misses"] += 1
+        task = _in_flight[key] = asyncio.create_task(generate_news_summary(email_summary))
+
+        def finish(task: asyncio.Task):
+            _in_flight.pop(key, None)
+            if not task.cancelled() and task.exception() is None:
+                _deep_dives.set(key, task.result())
+
+        task.add_done_callback(finish)
+    else:
+        deep_dive_stats["coalesced"] += 1
+    if DEBUG >= 1:
+        print(f"Deep dive cache: {dict(deep_dive_stats)}", flush=True)
+    return await asyncio.shield(task)
+
+
 def generate_calendar_event_details(request):
     content = f"""
     Event: {request.summary}
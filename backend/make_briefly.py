@@ -1,16 +1,41 @@
-import asyncio, os
-from typing import List, Tuple, Optional
+import asyncio, re, time
+from typing import AsyncIterator, List, Literal, Tuple, Optional
 from pydantic import BaseModel, Field
-from anthropic import AsyncAnthropic
-from instructor import from_anthropic, Mode
 
 from integrations.gmail import (
-    get_messages_since_yesterday,
+    stream_messages_since_yesterday,
     get_attendee_email_threads,
+    GMAIL_BATCH_SIZE,
     GmailMessage,
+    ThreadCache,
+    load_message_bodies,
 )
+from integrations.gmail_sync import remember_bodies, sync_messages_since_yesterday
 from integrations.google_calendar import get_today_events, CalendarEvent
-from helpers import DEBUG
+from llm_cache import llm_cache, make_key
+from llm_gateway import llm
+from preclassify import preclassify, stats as preclassify_stats
+from tokens import truncate_to_tokens
+from helpers import DEBUG, getenv
+
+EVENT_CONCURRENCY = getenv("EVENT_CONCURRENCY", 4)  # events gathering context at once
+CLASSIFY_BATCH_SIZE = getenv("CLASSIFY_BATCH_SIZE", 20)  # emails per classification request
+CATEGORIES = ("personal", "news", "spam")
+CLASSIFY_MODEL = "claude-3-5-sonnet-20240620"
+PERSONAL_TOKEN_BUDGET = getenv("PERSONAL_TOKEN_BUDGET", 6000)  # personal email body tokens summarized, the rest is dropped
+EMAIL_TOKEN_BUDGET = getenv("EMAIL_TOKEN_BUDGET", 40000)  # newsletter body tokens summarized, the rest is dropped
+SUMMARY_WORKERS = getenv("SUMMARY_WORKERS", 8)  # email summaries in flight per request
+# shared by the single and batched classification prompts
+CLASSIFY_INSTRUCTIONS = """    <categories>
+    personal
+    news
+    spam
+    </categories>
+
+    personal emails are emails from individuals or emails directed to me. I am personally uninterested in emails that act as notifications.
+    news emails are typically newsletters with news about what's going on in the world. 
+    spam emails are often promotional emails that try to sell products, ask for donations, notify of sales, or notify terms of service changes 
+"""
 
 
 class EmailResponse(BaseModel):
@@ -19,6 +44,25 @@ class EmailResponse(BaseModel):
     spam_emails: List[GmailMessage]
 
 
+class EmailTotals(BaseModel):
+    personal: int
+    news: int
+    spam: int
+    cost: float
+    seconds: float
+
+
+class EmailEvent(BaseModel):
+    """
+    classified and summarized events carry the email, done carries the full response and totals
+    """
+
+    event: Literal["classified", "summarized", "done"]
+    email: Optional[GmailMessage] = None
+    response: Optional[EmailResponse] = None
+    totals: Optional[EmailTotals] = None
+
+
 class NewsletterSummary(BaseModel):
     """
     A summary of a newsletter, represented as a comma-separated list containing key topics and their brief descriptions.
@@ -39,7 +83,7 @@ def anthropic_cost(usage):
     )  # sonnet pricing
 
 
-async def summarize_thread(client, thread):
+async def summarize_thread(thread):
     thread_messages = [t["messages"][0] for t in thread]
     attendees = [t["attendees"] for t in thread]
     all_participants = [t["all_participants"] for t in thread]
@@ -60,7 +104,7 @@ async def summarize_thread(client, thread):
     Focus on information relevant to the attendees listed above.
     """
 
-    response = await client.messages.create(
+    response = await llm.create(
         messages=[{"role": "user", "content": prompt}],
         max_tokens=1024,
         temperature=0.0,
@@ -70,61 +114,92 @@ async def summarize_thread(client, thread):
     return response.content[0].text.strip(), cost
 
 
-async def get_event_related_emails(token: Optional[str] = None, self_email: str = "") -> CalendarResponse:
+async def add_event_context(
+    event: CalendarEvent, self_email: str, thread_cache: ThreadCache, semaphore: asyncio.Semaphore
+) -> float:
     """
-    Get's emails related to todays events
+    Gmail threads shared by the event's attendees -> event.context
     """
-    client = AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-
-    # Get today's events
-    events: List[CalendarEvent] = get_today_events(token=token)
-
-    total_cost = 0
-    for event in events:
-        attendees = event.attendees
+    async with semaphore:
+        start = time.perf_counter()
         non_self_attendees = [
-            attendee for attendee in attendees if attendee != self_email
+            attendee for attendee in event.attendees if attendee != self_email
         ]
+        thread_messages = await get_attendee_email_threads(non_self_attendees, cache=thread_cache)
+        fetched = time.perf_counter()
 
-        thread_messages = get_attendee_email_threads(non_self_attendees, token=token)
-
+        cost = 0
         if thread_messages:
             # Summarize the thread
-            summary, cost = await summarize_thread(client, thread_messages)
+            summary, cost = await summarize_thread(thread_messages)
             event.context = summary
-            total_cost += cost
+
+    if DEBUG >= 1:
+        print(
+            f"Event '{event.summary}': {len(thread_messages)} threads, "
+            f"gmail {fetched - start:.2f}s, summary {time.perf_counter() - fetched:.2f}s",
+            flush=True,
+        )
+    return cost
+
+
+async def get_event_related_emails(token: Optional[str] = None, self_email: str = "") -> CalendarResponse:
+    """
+    Get's emails related to todays events
+    Events are processed concurrently, up to EVENT_CONCURRENCY at a time
+    """
+    start = time.perf_counter()
+
+    # Get today's events, events often share attendees so reuse their thread listings and threads
+    events, thread_cache = await asyncio.gather(
+        get_today_events(token=token, user_key=self_email or None),
+        ThreadCache.create(token),
+    )
+    events: List[CalendarEvent]
+
+    semaphore = asyncio.Semaphore(EVENT_CONCURRENCY)
+    costs = await asyncio.gather(
+        *[add_event_context(event, self_email, thread_cache, semaphore) for event in events]
+    )
+    total_cost = sum(costs)
 
     if DEBUG >= 1:
         print(f"\033[95mTotal Cost: ${total_cost:.5f}\033[0m", flush=True)
+        print(f"{len(events)} events in {time.perf_counter() - start:.2f}s", flush=True)
 
     return CalendarResponse(events=events)
 
 
-async def classify_email(client, email: GmailMessage) -> Tuple[str, float]:
+def classification_text(email: GmailMessage) -> str:
+    return (email.body if email.body_loaded else email.snippet)[:500]
+
+
+def classification_key(email: GmailMessage, user_key: Optional[str] = None) -> str:
+    """
+    Everything the label depends on: model, instructions and the exact email text the prompt shows
+    """
+    return make_key(
+        kind="classification", model=CLASSIFY_MODEL, instructions=CLASSIFY_INSTRUCTIONS, user=user_key,
+        sender=email.sender, subject=email.subject, text=classification_text(email),
+    )
+
+
+async def classify_email(email: GmailMessage) -> Tuple[str, float]:
     """
     Classifies personal, news, and spam emails
     """
     prompt = f"""
     Classify the following email into one of the following categories:
-    <categories>
-    personal
-    news
-    spam
-    </categories>
-
-    personal emails are emails from individuals or emails directed to me. I am personally uninterested in emails that act as notifications.
-    news emails are typically newsletters with news about what's going on in the world. 
-    spam emails are often promotional emails that try to sell products, ask for donations, notify of sales, or notify terms of service changes 
-
+{CLASSIFY_INSTRUCTIONS}
     Here is the email:
     <email>
     From: {email.sender}
     Subject: {email.subject}
-    Body: {email.body[:500]}...
+    Body: {classification_text(email)}...
     </email>
     """
 
-    response = await client.messages.create(
+    response = await llm.create(
         messages=[
             {"role": "user", "content": prompt},
             {"role": "assistant", "content": "<category>"},
@@ -132,13 +207,93 @@ async def classify_email(client, email: GmailMessage) -> Tuple[str, float]:
         stop_sequences=["</category>"],
         max_tokens=64,
         temperature=0.0,
-        model="claude-3-5-sonnet-20240620",
+        model=CLASSIFY_MODEL,
     )
     cost = anthropic_cost(response.usage)
     return response.content[0].text.strip(), cost
 
 
-async def summarize_personal_email(client, email: GmailMessage) -> Tuple[str, int]:
+async def classify_email_batch(emails: List[GmailMessage]) -> Tuple[List[Optional[str]], float]:
+    """
+    Classifies several emails in one request, sharing the instructions
+    Returns a label per email, None where the model's answer is missing or invalid
+    """
+    email_blocks = "\n".join(
+        f"""    <email id="{i}">
+    From: {email.sender}
+    Subject: {email.subject}
+    Body: {classification_text(email)}...
+    </email>"""
+        for i, email in enumerate(emails, start=1)
+    )
+    prompt = f"""
+    Classify each of the following emails into one of the following categories:
+{CLASSIFY_INSTRUCTIONS}
+    Here are the emails:
+{email_blocks}
+
+    Answer with one line per email in the form "id: category", covering every id from 1 to {len(emails)}.
+    """
+
+    response = await llm.create(
+        messages=[
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": "<labels>"},
+        ],
+        stop_sequences=["</labels>"],
+        max_tokens=16 * len(emails) + 32,
+        temperature=0.0,
+        model=CLASSIFY_MODEL,
+    )
+    cost = anthropic_cost(response.usage)
+
+    labels: List[Optional[str]] = [None] * len(emails)
+    for match in re.finditer(r"^\s*(\d+)\s*:\s*([a-z]+)\s*$", response.content[0].text, re.MULTILINE):
+        index, category = int(match.group(1)) - 1, match.group(2)
+        if 0 <= index < len(emails) and category in CATEGORIES:
+            labels[index] = category
+    return labels, cost
+
+
+async def classify_emails(
+    emails: List[GmailMessage], batch_size: int = CLASSIFY_BATCH_SIZE, user_key: Optional[str] = None
+) -> Tuple[List[str], float]:
+    """
+    Batched classification, emails the batch answer missed fall back to one request each
+    Labels are also cached per email and user in the gateway's cache, so batch composition doesn't affect hits
+    """
+    cache = llm.cache
+    keys = [classification_key(email, user_key) for email in emails]
+    if cache is not None:
+        labels: List[Optional[str]] = list(await asyncio.gather(*[cache.get_value(key) for key in keys]))
+    else:
+        labels = [None] * len(emails)
+    uncached = [i for i, label in enumerate(labels) if label is None]
+
+    batches = [uncached[i : i + batch_size] for i in range(0, len(uncached), batch_size)]
+    results = await asyncio.gather(
+        *[classify_email_batch([emails[i] for i in batch]) for batch in batches]
+    )
+    for batch, (batch_labels, _) in zip(batches, results):
+        for i, label in zip(batch, batch_labels):
+            labels[i] = label
+    total_cost = sum(cost for _, cost in results)
+
+    missing = [i for i, label in enumerate(labels) if label is None]
+    if missing:
+        if DEBUG >= 1:
+            print(f"Batched classification missed {len(missing)} emails, classifying individually", flush=True)
+        fallback = await asyncio.gather(*[classify_email(emails[i]) for i in missing])
+        for i, (label, cost) in zip(missing, fallback):
+            labels[i] = label
+            total_cost += cost
+
+    if cache is not None:
+        await asyncio.gather(*[cache.set_value(keys[i], labels[i]) for i in uncached if labels[i] in CATEGORIES])
+    return labels, total_cost
+
+
+async def summarize_personal_email(email: GmailMessage) -> Tuple[str, int]:
     """
     Succinctly summarize personal emails
     """
@@ -149,12 +304,12 @@ async def summarize_personal_email(client, email: GmailMessage) -> Tuple[str, in
     <email>
     From: {email.sender}
     Subject: {email.subject}
-    Body: {email.body}
+    Body: {truncate_to_tokens(email.body, PERSONAL_TOKEN_BUDGET)}
     </email>
 
     It is critical to capture the central message the email is trying to convey. Keep the summary very short.
     """
-    response = await client.messages.create(
+    response = await llm.create(
         messages=[
             {"role": "user", "content": prompt},
             {"role": "assistant", "content": "<summary>"},
@@ -169,7 +324,7 @@ async def summarize_personal_email(client, email: GmailMessage) -> Tuple[str, in
 
 
 async def summarize_news_email(
-    client, email: GmailMessage
+    email: GmailMessage
 ) -> Tuple[NewsletterSummary, float]:
     """
     Summarize news emails
@@ -180,9 +335,9 @@ async def summarize_news_email(
     NewsLetter:
     From: {email.sender}
     Subject: {email.subject}
-    Body: {email.body}
+    Body: {truncate_to_tokens(email.body, EMAIL_TOKEN_BUDGET)}
     """
-    response_model, completion = await client.messages.create_with_completion(
+    response_model, completion = await llm.create_with_completion(
         model="claude-3-5-sonnet-20240620",
         max_tokens=2048,
         max_retries=3,
@@ -193,59 +348,169 @@ async def summarize_news_email(
     return response_model, cost
 
 
-async def get_email_data(
+async def summarize_email(email: GmailMessage) -> float:
+    if email.classification == "personal":
+        email.summary, cost = await summarize_personal_email(email)
+    elif email.classification == "news":
+        summary, cost = await summarize_news_email(email)
+        email.summary = summary.topic_summaries
+    else:
+        cost = 0.0
+    return cost
+
+
+async def process_email_batch(
+    emails: List[GmailMessage],
+    pending: List[GmailMessage],
+    semaphore: asyncio.Semaphore,
+    events: asyncio.Queue,
     token: Optional[str] = None,
-) -> Tuple[List[GmailMessage], List[GmailMessage]]:
+    user_key: Optional[str] = None,
+) -> float:
+    """
+    One chain of the email pipeline: classify the emails the pre-classifier left pending,
+    download bodies for the personal and news ones, then summarize each as a worker frees up
+    Chains run independently, a slow classification only holds back its own emails
+    Every email is put on events once classified and again once summarized
+    """
+    for email in emails:
+        if email.classification is not None:
+            events.put_nowait(EmailEvent(event="classified", email=email))
+    cost = 0.0
+    if pending:
+        labels, cost = await classify_emails(pending, user_key=user_key)
+        for email, classification in zip(pending, labels):
+            email.classification = classification
+            events.put_nowait(EmailEvent(event="classified", email=email))
+
+    # spam is never summarized, skip downloading its bodies
+    kept = [email for email in emails if email.classification in ("personal", "news")]
+    await load_message_bodies(kept, token=token)
+
+    async def summarize(email: GmailMessage) -> float:
+        async with semaphore:
+            email_cost = await summarize_email(email)
+        events.put_nowait(EmailEvent(event="summarized", email=email))
+        return email_cost
+
+    return cost + sum(await asyncio.gather(*[summarize(email) for email in kept]))
+
+
+async def stream_email_data(token: Optional[str] = None, user_key: Optional[str] = None) -> AsyncIterator[EmailEvent]:
+    """
+    Emails from the past day as they move through the pipeline
+    Each batch goes classify -> bodies -> summaries as soon as it is read, with at most SUMMARY_WORKERS summaries at once
+    Yields classified and summarized events per email, then a done event with the response and totals
+    """
+    start = time.perf_counter()
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        if user_key is not None:
+            email_stream = sync_messages_since_yesterday(user_key, token=token, format="metadata")
+        else:
+            email_stream = stream_messages_since_yesterday(token=token, format="metadata")
+        semaphore = asyncio.Semaphore(SUMMARY_WORKERS)
+        emails: List[GmailMessage] = []
+        batch: List[GmailMessage] = []
+        pending: List[GmailMessage] = []  # left to the LLM by the pre-classifier
+        chains: List[asyncio.Task] = []
+        classified = 0
+        try:
+            async for email in email_stream:
+                emails.append(email)
+                batch.append(email)
+                email.classification = preclassify(email)
+                if email.classification is None:
+                    pending.append(email)
+                if len(pending) == CLASSIFY_BATCH_SIZE or len(batch) == GMAIL_BATCH_SIZE:
+                    chains.append(asyncio.create_task(process_email_batch(batch, pending, semaphore, events, token, user_key)))
+                    classified += len(pending)
+                    batch, pending = [], []
+            if batch:
+                chains.append(asyncio.create_task(process_email_batch(batch, pending, semaphore, events, token, user_key)))
+                classified += len(pending)
+            total_cost = sum(await asyncio.gather(*chains))
+        except Exception as e:
+            events.put_nowait(e)
+            return
+        finally:
+            # on errors and client disconnects, stop chains still spending LLM calls and release the sync lock
+            for chain in chains:
+                chain.cancel()
+            await asyncio.gather(*chains, return_exceptions=True)
+            await email_stream.aclose()
+        if user_key is not None:
+            # the sync state is stored once the stream completes
+            remember_bodies(user_key, [email for email in emails if email.body_loaded])
+        if DEBUG >= 1:
+            print(
+                f"Pre-classifier decided {len(emails) - classified}/{len(emails)} emails locally "
+                f"({preclassify_stats['llm_calls_avoided']} LLM classifications avoided since startup)",
+                flush=True,
+            )
+            print(f"{len(emails)} emails in {len(chains)} chains, {time.perf_counter() - start:.2f}s", flush=True)
+
+        personal, news, spam = [], [], []
+        for email in emails:
+            if email.classification == "personal":
+                personal.append(email)
+            elif email.classification == "news":
+                news.append(email)
+            elif email.classification == "spam":
+                spam.append(email)
+        totals = EmailTotals(
+            personal=len(personal), news=len(news), spam=len(spam),
+            cost=total_cost, seconds=time.perf_counter() - start,
+        )
+        response = EmailResponse(personal_emails=personal, news_emails=news, spam_emails=spam)
+        events.put_nowait(EmailEvent(event="done", response=response, totals=totals))
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            event = await events.get()
+            if isinstance(event, Exception):
+                raise event
+            yield event
+            if event.event == "done":
+                break
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
+async def replay_email_data(response: EmailResponse, cost: float = 0.0) -> AsyncIterator[EmailEvent]:
+    """
+    The events stream_email_data yields, for a response that was already built (DEV pickles, stored briefings)
+    """
+    emails = response.personal_emails + response.news_emails + response.spam_emails
+    for email in emails:
+        yield EmailEvent(event="classified", email=email)
+    for email in emails:
+        if email.classification in ("personal", "news"):
+            yield EmailEvent(event="summarized", email=email)
+    totals = EmailTotals(
+        personal=len(response.personal_emails), news=len(response.news_emails), spam=len(response.spam_emails),
+        cost=cost, seconds=0.0,
+    )
+    yield EmailEvent(event="done", response=response, totals=totals)
+
+
+async def get_email_data(
+    token: Optional[str] = None, user_key: Optional[str] = None
+) -> EmailResponse:
     """
     Gets emails from past day
     Classifies them as personal, news, spam
     Summarizes them
+    user_key enables incremental gmail sync between calls
+    Emails are fetched as metadata, only personal and news emails get their bodies downloaded
     """
-    # get emails
-    emails: List[GmailMessage] = get_messages_since_yesterday(token=token)
-
-    # classify emails
-    client = AsyncAnthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-    classification_tasks = [classify_email(client, email) for email in emails]
-    results = await asyncio.gather(*classification_tasks)
-    classifications = [result[0] for result in results]
-    total_cost = sum([result[1] for result in results])
-
-    # save classification and filter
-    personal, news, spam = [], [], []
-    for email, classification in zip(emails, classifications):
-        email.classification = classification
-        if classification == "personal":
-            personal.append(email)
-        elif classification == "news":
-            news.append(email)
-        elif classification == "spam":
-            spam.append(email)
-
-    # Summarize personal emails
-    personal_email_tasks = [
-        summarize_personal_email(client, email) for email in personal
-    ]
-    personal_email_results = await asyncio.gather(*personal_email_tasks)
-    personal_summaries = [result[0] for result in personal_email_results]
-    for email, summary in zip(personal, personal_summaries):
-        email.summary = summary
-    total_cost += sum([result[1] for result in personal_email_results])
-
-    # Summarize news emails
-    instructor_client = from_anthropic(
-        client=AsyncAnthropic(), mode=Mode.ANTHROPIC_JSON
-    )
-    news_email_tasks = [
-        summarize_news_email(instructor_client, email) for email in news
-    ]
-    news_email_results = await asyncio.gather(*news_email_tasks)
-    news_summaries: List[NewsletterSummary] = [
-        result[0] for result in news_email_results
-    ]
-    for email, summary in zip(news, news_summaries):
-        email.summary = summary.topic_summaries
-    total_cost += sum([result[1] for result in news_email_results])
+    async for event in stream_email_data(token=token, user_key=user_key):
+        if event.event == "done":
+            response, total_cost = event.response, event.totals.cost
+    personal, news, spam = response.personal_emails, response.news_emails, response.spam_emails
 
     # printing
     if DEBUG >= 1:
@@ -263,8 +528,9 @@ async def get_email_data(
             print(f"Summary: {email.summary}", flush=True)
             print("---", flush=True)
         print(f"\033[95mTotal Cost: ${total_cost:.5f}\033[0m", flush=True)
+        llm_cache.report()
 
-    return EmailResponse(personal_emails=personal, news_emails=news, spam_emails=spam)
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+"""
+Deep-dive research context: main content of each page, cut into passages and ranked with BM25
+against the news segment, keeping the best passages that fit RESEARCH_TOKEN_BUDGET
+Extraction is readability-style: drop chrome (nav, footers, cookie banners, share bars), score
+containers by the paragraph text they hold less link text, keep the best container's paragraphs
+"""
+import math, re
+from collections import Counter
+from typing import Dict, List
+from bs4 import BeautifulSoup, Tag
+
+from helpers import getenv
+from tokens import chunk_text, estimate_tokens
+
+RESEARCH_TOKEN_BUDGET = getenv("RESEARCH_TOKEN_BUDGET", 6000)  # research tokens in the deep-dive prompt
+PASSAGE_TOKENS = getenv("PASSAGE_TOKENS", 150)  # unit of ranking
+MIN_PARAGRAPH_CHARS = 25  # shorter blocks are captions, bylines and buttons
+BM25_K1, BM25_B = 1.5, 0.75
+
+NON_CONTENT_TAGS = [
+    "script", "style", "noscript", "template", "svg", "iframe", "form", "button", "nav", "header", "footer", "aside"
+]
+BLOCK_TAGS = ["p", "h1", "h2", "h3", "h4", "h5", "h6", "li", "blockquote", "pre", "td"]
+UNLIKELY = re.compile(
+    r"comment|footer|nav|menu|sidebar|cookie|consent|banner|share|social|subscribe|newsletter|promo|related|"
+    r"advert|sponsor|popup|modal|breadcrumb|signup|paywall|masthead|skip",
+    re.IGNORECASE,
+)
+LIKELY = re.compile(r"article|body|content|entry|main|post|story|text", re.IGNORECASE)
+WORD = re.compile(r"\w+")
+STOPWORDS = set(
+    "a an and are as at be by for from has have he her his in is it its of on or that the their they this to was "
+    "were will with".split()
+)
+
+
+def _unlikely(tag: Tag) -> bool:
+    if tag.attrs is None or tag.name in ("html", "body", "article", "main"):
+        return False
+    names = " ".join(tag.get("class") or []) + " " + (tag.get("id") or "")
+    return bool(UNLIKELY.search(names)) and not LIKELY.search(names)
+
+
+def _link_density(tag: Tag, text_length: int) -> float:
+    link_length = sum(len(a.get_text(" ", strip=True)) for a in tag.find_all("a"))
+    return link_length / max(text_length, 1)
+
+
+def extract_main_text(html: str) -> List[str]:
+    """
+    Paragraphs of the page's main content, falling back to every text block when no container stands out
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(NON_CONTENT_TAGS):
+        tag.decompose()
+    for tag in soup.find_all(_unlikely):
+        if not tag.decomposed:
+            tag.decompose()
+
+    scores: Dict[int, float] = {}
+    containers: Dict[int, Tag] = {}
+    blocks = []
+    for block in soup.find_all(BLOCK_TAGS):
+        if block.find(BLOCK_TAGS):  # nested blocks (li holding p) are scored on the inner ones
+            continue
+        text = block.get_text(" ", strip=True)
+        if len(text) < MIN_PARAGRAPH_CHARS:
+            continue
+        blocks.append((block, text))
+        score = 1 + text.count(",") + min(len(text) / 100, 3)
+        for ancestor, weight in ((block.parent, 1.0), (block.parent and block.parent.parent, 0.5)):
+            if isinstance(ancestor, Tag):
+                containers[id(ancestor)] = ancestor
+                scores[id(ancestor)] = scores.get(id(ancestor), 0) + score * weight
+    if not scores:
+        return [line for line in (line.strip() for line in soup.get_text("\n").splitlines()) if line]
+
+    def final_score(key: int) -> float:
+        container = containers[key]
+        return scores[key] * (1 - _link_density(container, len(container.get_text(" ", strip=True))))
+
+    best = containers[max(scores, key=final_score)]
+    paragraphs = [
+        text for block, text in blocks
+        if (block is best or any(parent is best for parent in block.parents)) and _link_density(block, len(text)) < 0.5
+    ]
+    return paragraphs or [text for _, text in blocks]
+
+
+def passages(paragraphs: List[str], max_tokens: int = PASSAGE_TOKENS) -> List[str]:
+    """
+    Neighbouring short paragraphs are joined and long ones split, so passages are comparable in length
+    """
+    result: List[str] = []
+    current = ""
+    for paragraph in paragraphs:
+        for piece in chunk_text(paragraph, max_tokens):
+            if current and estimate_tokens(current) + estimate_tokens(piece) > max_tokens:
+                result.append(current)
+                current = piece
+            else:
+                current = f"{current}\n{piece}" if current else piece
+    if current:
+        result.append(current)
+    return result
+
+
+def terms(text: str) -> List[str]:
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+def bm25_scores(query: str, documents: List[str]) -> List[float]:
+    tokenized = [Counter(terms(document)) for document in documents]
+    lengths = [sum(counts.values()) for counts in tokenized]
+    average = sum(lengths) / max(len(lengths), 1) or 1
+    document_frequency = Counter(term for counts in tokenized for term in counts)
+    scores = []
+    for counts, length in zip(tokenized, lengths):
+        score = 0.0
+        for term in set(terms(query)):
+            frequency = counts.get(term, 0)
+            if not frequency:
+                continue
+            n = document_frequency[term]
+            idf = math.log(1 + (len(documents) - n + 0.5) / (n + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average))
+        scores.append(score)
+    return scores
+
+
+def build_research(query: str, pages: List[str], budget: int = RESEARCH_TOKEN_BUDGET) -> List[str]:
+    """
+    html pages -> per page text of its passages most relevant to query, within budget tokens overall
+    Passages keep their page order so each page still reads top to bottom; pages with nothing selected are ""
+    """
+    candidates = [
+        (page, i, passage)
+        for page, html in enumerate(pages)
+        for i, passage in enumerate(passages(extract_main_text(html)))
+    ]
+    scores = bm25_scores(query, [passage for _, _, passage in candidates])
+    selected = []
+    used = 0
+    for score, (page, i, passage) in sorted(zip(scores, candidates), key=lambda item: -item[0]):
+        cost = estimate_tokens(passage)
+        if used + cost > budget:
+            continue
+        selected.append((page, i, passage))
+        used += cost
+    research = [[] for _ in pages]
+    for page, i, passage in sorted(selected):
+        research[page].append(passage)
+    return ["\n\n".join(page) for page in research]
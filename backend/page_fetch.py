@@ -0,0 +1,66 @@
+"""
+First tier of deep-dive page fetching: plain http over the shared aiohttp pool
+needs_browser flags JS-only shells (little visible text, or a noscript wall) for the browser tier,
+make_briefless.scrape_urls. Failed fetches (error statuses, timeouts) are dropped, a browser wouldn't fare better
+"""
+import asyncio, re
+from typing import Optional
+import aiohttp
+
+from http_session import get_session
+from integrations.email_body import get_engine
+from fixtures import fixture_key, fixtures
+from helpers import DEBUG, getenv
+
+PAGE_FETCH_TIMEOUT = getenv("PAGE_FETCH_TIMEOUT", 8.0)  # seconds per page, connect to last byte
+PAGE_MAX_BYTES = getenv("PAGE_MAX_BYTES", 2_000_000)  # larger pages are cut off
+PAGE_MIN_TEXT_CHARS = getenv("PAGE_MIN_TEXT_CHARS", 500)  # less visible text than this is treated as a JS shell
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+NOSCRIPT = re.compile(r"<noscript[^>]*>(.*?)</noscript>", re.IGNORECASE | re.DOTALL)
+JS_REQUIRED = re.compile(r"enable javascript|javascript is (?:required|disabled)|requires javascript", re.IGNORECASE)
+
+
+async def fetch_html(url: str) -> Optional[str]:
+    """
+    None for errors, non-html responses and timeouts
+    """
+    try:
+        timeout = aiohttp.ClientTimeout(total=PAGE_FETCH_TIMEOUT)
+        async with get_session().get(url, headers=HEADERS, timeout=timeout, allow_redirects=True) as response:
+            if response.status != 200 or "html" not in response.headers.get("Content-Type", "text/html"):
+                if DEBUG >= 1:
+                    print(f"Fetch {url}: {response.status} {response.headers.get('Content-Type')}", flush=True)
+                return None
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                body += chunk
+                if len(body) >= PAGE_MAX_BYTES:
+                    break
+            return bytes(body[:PAGE_MAX_BYTES]).decode(response.get_encoding() or "utf-8", errors="replace")
+    except (aiohttp.ClientError, asyncio.TimeoutError, LookupError, RuntimeError) as e:
+        if DEBUG >= 1:
+            print(f"Fetch {url} failed: {type(e).__name__} {e}", flush=True)
+        return None
+
+
+def needs_browser(html: Optional[str]) -> bool:
+    """
+    Only successfully fetched pages can be shells
+    """
+    if html is None:
+        return False
+    text_chars = len(get_engine()(html))
+    if text_chars < PAGE_MIN_TEXT_CHARS:
+        return True
+    # thin page whose noscript asks for javascript
+    return text_chars < 4 * PAGE_MIN_TEXT_CHARS and any(JS_REQUIRED.search(match) for match in NOSCRIPT.findall(html))
+
+
+async def fetch_page(url: str) -> Optional[str]:
+    return await fixtures.call("pages", fixture_key(url=url, tier="http"), lambda: fetch_html(url), description=url)
@@ -0,0 +1,75 @@
+"""
+Rule-based pre-classification from gmail labels and headers
+Obvious news and spam are decided locally, everything else goes to the LLM classifier
+"""
+import re
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from integrations.gmail import GmailMessage
+from helpers import DEBUG, getenv
+
+# minimum combined confidence to skip the LLM, per category
+THRESHOLDS: Dict[str, float] = {
+    "spam": getenv("PRECLASSIFY_SPAM_THRESHOLD", 0.9),
+    "news": getenv("PRECLASSIFY_NEWS_THRESHOLD", 0.9),
+}
+# the winning category must beat the runner-up by this much
+MARGIN = getenv("PRECLASSIFY_MARGIN", 0.3)
+
+NEWSLETTER_DOMAINS = re.compile(r"@(.+\.)?(substack\.com|beehiiv\.com|mail\.beehiiv\.com|convertkit\.com|buttondown\.email|ghost\.io|morningbrew\.com)$", re.I)
+NEWSLETTER_SUBJECT = re.compile(r"\b(newsletter|digest|daily|weekly|briefing|edition|issue #?\d+)\b", re.I)
+PROMO_SUBJECT = re.compile(r"(\d+% off|\bsale\b|\bdeal(s)?\b|\bcoupon\b|\bpromo\b|limited time|free shipping|last chance|\bdonate\b)", re.I)
+NOTIFICATION_SENDER = re.compile(r"^(no-?reply|do-?not-?reply|notifications?|alerts?|updates?)@", re.I)
+
+
+def is_bulk(email: GmailMessage) -> bool:
+    return email.headers.get("precedence", "").lower() in ("bulk", "list", "junk")
+
+
+def is_list_mail(email: GmailMessage) -> bool:
+    return "list-unsubscribe" in email.headers or "list-id" in email.headers
+
+
+# (name, category, confidence, predicate)
+RULES: List[Tuple[str, str, float, Callable[[GmailMessage], bool]]] = [
+    ("promotions_label", "spam", 0.9, lambda e: "CATEGORY_PROMOTIONS" in e.labels),
+    ("promo_subject", "spam", 0.6, lambda e: bool(PROMO_SUBJECT.search(e.subject))),
+    ("auto_submitted", "spam", 0.8, lambda e: e.headers.get("auto-submitted", "no").lower() != "no"),
+    ("notification_sender", "spam", 0.6, lambda e: bool(NOTIFICATION_SENDER.match(e.sender_email))),
+    ("updates_label", "spam", 0.4, lambda e: "CATEGORY_UPDATES" in e.labels),
+    ("bulk_precedence", "spam", 0.3, is_bulk),
+    ("newsletter_platform", "news", 0.9, lambda e: bool(NEWSLETTER_DOMAINS.search(e.sender_email))),
+    ("newsletter_subject", "news", 0.5, lambda e: is_list_mail(e) and bool(NEWSLETTER_SUBJECT.search(e.subject))),
+    ("list_mail", "news", 0.4, is_list_mail),
+]
+
+stats: Counter = Counter()  # process-wide: llm_calls_avoided, deferred_to_llm and per-rule hits
+
+
+def score(email: GmailMessage) -> Dict[str, float]:
+    """
+    Combined confidence per category, treating fired rules as independent evidence
+    """
+    misses = {"spam": 1.0, "news": 1.0}
+    for name, category, confidence, predicate in RULES:
+        if predicate(email):
+            misses[category] *= 1 - confidence
+            stats[f"rule:{name}"] += 1
+    return {category: 1 - miss for category, miss in misses.items()}
+
+
+def preclassify(email: GmailMessage) -> Optional[str]:
+    """
+    "spam" or "news" when the rules are confident enough, None to defer to the LLM
+    Personal email is never decided here
+    """
+    scores = score(email)
+    (best, best_score), (_, runner_up) = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    if best_score >= THRESHOLDS[best] and best_score - runner_up >= MARGIN:
+        stats["llm_calls_avoided"] += 1
+        if DEBUG >= 2:
+            print(f"Pre-classified {email.subject!r} as {best} ({best_score:.2f})", flush=True)
+        return best
+    stats["deferred_to_llm"] += 1
+    return None
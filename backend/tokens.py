@@ -0,0 +1,55 @@
+"""
+Token estimates and budget-aware text splitting
+Estimates are character based (~4 per token for english), good enough for budgeting prompts
+"""
+import re
+from typing import List
+
+CHARS_PER_TOKEN = 4
+SEPARATORS = [r"\n\s*\n", r"\n", r"(?<=[.!?])\s+", r"\s+"]  # paragraphs, lines, sentences, words
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cuts at the last whitespace before the budget
+    """
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", 0, limit)
+    return text[: cut if cut > limit // 2 else limit]
+
+
+def _split(text: str, max_chars: int, separators: List[str]) -> List[str]:
+    if len(text) <= max_chars:
+        return [text]
+    if not separators:
+        return [text[i : i + max_chars] for i in range(0, len(text), max_chars)]
+    pieces = []
+    for piece in re.split(separators[0], text):
+        if piece.strip():
+            pieces.extend(_split(piece.strip(), max_chars, separators[1:]))
+    return pieces
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """
+    Splits on the coarsest boundary that fits (paragraph, line, sentence, word), then packs
+    neighbouring pieces greedily so each chunk stays within max_tokens
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks: List[str] = []
+    current = ""
+    for piece in _split(text.strip(), max_chars, SEPARATORS):
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
@@ -6,15 +6,16 @@ from fastapi import Depends, HTTPException, status
 import jwt
 from pydantic import BaseModel
 from typing import Annotated, Optional
-from sqlalchemy import DateTime, String, func, create_engine, JSON, Integer
+from sqlalchemy import DateTime, String, func, create_engine, JSON, Integer, UniqueConstraint
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.engine import Engine
 from google.cloud.sql.connector import Connector, IPTypes
 from datetime import datetime, timedelta
+from cryptography.fernet import Fernet, InvalidToken
 import os
 
-from integrations.auth import get_google_api_service
+from integrations import google_async
 from helpers import DEV
 
 """ FastAPI Router """
@@ -25,6 +26,7 @@ router = APIRouter()
 SECRET_KEY = os.environ.get('SECRET_AUTH_KEY')
 ALGORITHM = os.environ.get('AUTH_ALGORITHM')
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 1 week
+REFRESH_TOKEN_KEY = os.environ.get('REFRESH_TOKEN_KEY')  # Fernet key, google refresh tokens are only kept when set
 
 
 """ Database Connection """
@@ -68,6 +70,20 @@ class UserDB(Base):
     recommendations = mapped_column(JSON, nullable=True)
 
 
+class BriefingDB(Base):
+    """
+    Briefings built by the scheduler, one row per user and kind, kept apart from UserDB so
+    authenticated requests don't load them and marking one served doesn't rewrite it
+    """
+    __tablename__ = "__briefings__"
+    __table_args__ = (UniqueConstraint("email", "kind"),)
+    email: Mapped[str] = mapped_column(String, nullable=False)
+    kind: Mapped[str] = mapped_column(String, nullable=False)  # emails or calendar
+    data = mapped_column(JSON, nullable=False)
+    computed_at = mapped_column(DateTime(timezone=True), nullable=False)
+    served_at = mapped_column(DateTime(timezone=True), nullable=True)  # set by the request that got it
+
+
 """ Pydantic Models """
 class CurrentUser(BaseModel):
     email: str
@@ -76,6 +92,7 @@ class CurrentUser(BaseModel):
 
 class GoogleToken(BaseModel):
     access_token: str
+    refresh_token: Optional[str] = None  # offline access, lets the scheduler build briefings before login
 
 class UserProfile(BaseModel):
     access_token: str
@@ -102,6 +119,19 @@ def create_access_token(data: dict, expires_delta: timedelta):
     return encoded_jwt
 
 
+def encrypt_token(token: str) -> Optional[str]:
+    if not REFRESH_TOKEN_KEY:
+        return None
+    return Fernet(REFRESH_TOKEN_KEY).encrypt(token.encode()).decode()
+
+
+def decrypt_token(token: str) -> Optional[str]:
+    try:
+        return Fernet(REFRESH_TOKEN_KEY).decrypt(token.encode()).decode()
+    except (InvalidToken, TypeError, ValueError):  # key rotated or unset
+        return None
+
+
 def create_user(email: str, session: Session):
     db_user = UserDB(email=email, recommendations=None)
     session.add(db_user)
@@ -130,8 +160,10 @@ async def get_current_user(token: str) -> CurrentUser:
         raise credentials_exception
 
 
-def query_google(service):
-    profile = service.people().get(resourceName='people/me', personFields='emailAddresses,names,photos').execute()
+async def query_google(service):
+    profile = await google_async.execute(
+        service.people().get(resourceName='people/me', personFields='emailAddresses,names,photos')
+    )
     email = profile.get('emailAddresses', [{}])[0].get('value')
     first_name = profile.get('names', [{}])[0].get('givenName')
     last_name = profile.get('names', [{}])[0].get('familyName')
@@ -142,13 +174,23 @@ def query_google(service):
 @router.post("/api/token", tags=["login"], response_model=UserProfile)
 async def register_user(token: GoogleToken, session: Session = Depends(get_session)):
     google_access_token = token.access_token
-    credentials = get_google_api_service('people', 'v1', google_access_token)
-    email, first_name, last_name, profile_pic = query_google(credentials)
+    credentials = await google_async.build_service('people', 'v1', google_access_token)
+    email, first_name, last_name, profile_pic = await query_google(credentials)
     print(email, first_name, last_name, profile_pic, flush=True)
     # Check if user exists in db, create if not
     user = session.query(UserDB).filter(UserDB.email == email).first()
     if user is None:
         user = create_user(email, session)
+    refresh_token = encrypt_token(token.refresh_token) if token.refresh_token else None
+    if refresh_token is not None or "google_token" in (user.recommendations or {}):
+        # row locked so a concurrent briefing write isn't lost, assigned anew since JSON columns don't track mutation
+        user = session.query(UserDB).filter(UserDB.email == email).with_for_update().one()
+        # plain access tokens were kept here before, drop them
+        recommendations = {key: value for key, value in (user.recommendations or {}).items() if key != "google_token"}
+        if refresh_token is not None:
+            recommendations["google_refresh_token"] = refresh_token
+        user.recommendations = recommendations
+        session.commit()
 
     # Create JWT token encoding email and google_access_token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -56,7 +56,8 @@ const OAuthRedirectDesktop = () => {
           headers: {
             'Content-Type': 'application/json',
           },
-          body: JSON.stringify({ access_token: accessToken}),
+          // the refresh token lets the backend build briefings before the user opens the app
+          body: JSON.stringify({ access_token: accessToken, refresh_token: data.refresh_token }),
         })
         .then(response => response.json())
         .then(data => {